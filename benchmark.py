@@ -0,0 +1,130 @@
+"""
+Benchmarks of report parsing and email rendering.
+
+Peak memory of parsing large Analytics reports. Run once per size and mode in separate processes, since peak RSS
+only grows:
+    python benchmark.py spill --rows 50000
+    python benchmark.py spill --rows 500000
+    python benchmark.py spill --rows 500000 --in-memory
+
+Size of the compact email body against the inline-styled one. Exits with an error if the compact body is not at
+least --max-ratio times smaller. The Benchmark workflow runs it on every push:
+    python benchmark.py payload --rows 500 --columns 10
+"""
+import argparse
+import gzip
+import resource
+import sys
+import tempfile
+import time
+from controllers import build_csv_attachment, render_template
+from spill import RowFile, parse_file
+
+
+def peak_rss() -> int:
+    """
+    Get the peak resident set size of the process in MB
+
+    :return: int
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+def spill_benchmark(count: int, in_memory: bool) -> None:
+    """
+    Parse a generated Analytics response and write it as an attachment, then print the peak RSS
+
+    The peak RSS of the disk-backed mode should stay roughly the same as the number of rows grows.
+
+    :param count: number of rows
+    :param in_memory: keep the rows in memory instead of spilling them to disk
+    :return: None
+    """
+    with tempfile.TemporaryFile() as body:  # Generate the response on disk
+        body.write(
+            b'<report><QueryResult><ResultXml><rowset xmlns="urn:schemas-microsoft-com:xml-analysis:rowset">'
+            b'<xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:saw-sql="urn:saw-sql">'
+            + b''.join(
+                f'<xsd:element name="Column{i}" saw-sql:columnHeading="Heading {i}"/>'.encode() for i in range(8)
+            )
+            + b'</xsd:schema>'
+        )
+
+        for row in range(count):
+            body.write(b'<Row>' + b''.join(f'<Column{i}>{row:010d}-{i}</Column{i}>'.encode() for i in range(8)))
+            body.write(b'</Row>')
+
+        body.write(b'</rowset><IsFinished>true</IsFinished></ResultXml></QueryResult></report>')
+        body.seek(0)
+
+        start = time.perf_counter()  # Start the timer
+
+        rows: RowFile | list = [] if in_memory else RowFile()  # Keep the rows as a report below or above the budget
+        columns = parse_file(body, rows)
+
+        if isinstance(rows, RowFile):  # Map the rows for reading
+            rows.finish()
+
+        attachment = build_csv_attachment('benchmark', columns, rows)  # type:ignore[arg-type]
+
+    mode = 'in memory' if in_memory else 'on disk'
+    print(f'{count} rows {mode}: {time.perf_counter() - start:.2f}s, {len(attachment.content)} byte attachment, '
+          f'peak RSS {peak_rss()} MB')
+
+
+def payload_benchmark(count: int, width: int, max_ratio: float) -> bool:
+    """
+    Render a generated report with both email templates and compare their sizes
+
+    :param count: number of rows
+    :param width: number of columns
+    :param max_ratio: largest allowed size of the compact body relative to the inline-styled body
+    :return: whether the compact body is within max_ratio
+    """
+    columns = {f'Column{i}': f'Heading {i}' if i else '0' for i in range(width + 1)}  # Column0 is hidden
+    rows = [{key: f'{row:010d}' for key in columns} for row in range(count)]  # Generate the rows
+    kwargs = {
+        'rows': rows,
+        'columns': columns,
+        'column_keys': list(columns.keys()),
+        'visible_keys': [key for key, heading in columns.items() if heading != '0'],
+        'title': 'BENCHMARK',
+        'total_rows': count,
+        'attachment': None
+    }
+    sizes = {}  # Create a dictionary of body sizes
+
+    for template in ('email.html', 'email_compact.html'):  # Render each template
+        start = time.perf_counter()  # Start the timer
+        body = render_template(template, **kwargs).encode('utf-8')  # Render the body
+        elapsed = time.perf_counter() - start  # Stop the timer
+        sizes[template] = len(body)
+
+        print(f'{template}: {len(body)} bytes, {len(gzip.compress(body))} gzipped, rendered in {elapsed:.3f}s')
+
+    ratio = sizes['email_compact.html'] / sizes['email.html']  # Compare the sizes
+
+    print(f'compact/inline: {ratio:.2f} (max {max_ratio:.2f})')
+
+    return ratio <= max_ratio
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark report parsing and email rendering')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    spill = commands.add_parser('spill', help='peak memory of parsing a large Analytics report')
+    spill.add_argument('--rows', type=int, default=200_000, help='number of rows')
+    spill.add_argument('--in-memory', action='store_true', help='parse in memory instead of spilling to disk')
+
+    payload = commands.add_parser('payload', help='size of the compact email body against the inline-styled one')
+    payload.add_argument('--rows', type=int, default=500, help='number of rows')
+    payload.add_argument('--columns', type=int, default=10, help='number of columns')
+    payload.add_argument('--max-ratio', type=float, default=0.2, help='largest allowed compact/inline size ratio')
+
+    args = parser.parse_args()
+
+    if args.command == 'spill':
+        spill_benchmark(args.rows, args.in_memory)
+    elif not payload_benchmark(args.rows, args.columns, args.max_ratio):
+        sys.exit(1)
@@ -0,0 +1,282 @@
+"""
+Run a trigger from the command line, outside the Azure Functions host.
+
+Example:
+    python cli.py scf_duplicate --db sqlite:///local.db --alma recorded/ --outbox outbox/ --workers 4 --profile
+"""
+import argparse
+import cProfile
+import gzip
+import itertools
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import urllib.parse
+from collections import Counter
+from functools import partial
+from typing import Any, Callable
+from pathlib import Path
+import requests  # type:ignore[import-untyped]
+from requests.adapters import BaseAdapter, HTTPAdapter  # type:ignore[import-untyped]
+
+
+def recording_name(request: requests.PreparedRequest, pages: Counter) -> str:
+    """
+    Get the file name of the recorded response for an Analytics request
+
+    The first page of a report is named after its path. The later pages are all requested with the report's
+    ResumptionToken, so they are named after the token and numbered in the order they are requested.
+
+    :param request: PreparedRequest
+    :param pages: Counter of the pages requested per token
+    :return: str
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(str(request.url)).query)  # Parse the query string
+
+    if 'path' in query:  # Name the first page after the report path
+        return urllib.parse.quote(query['path'][0], safe='') + '.xml'
+
+    token = query.get('token', [''])[0]  # Get the report's token
+    pages[token] += 1  # Count the page; a report's pages are requested one after another
+
+    return f"{urllib.parse.quote(token, safe='')}-{pages[token] + 1}.xml"
+
+
+class RecordedAdapter(BaseAdapter):
+    """
+    Serve Alma Analytics responses from a directory of recorded XML files
+    """
+    def __init__(self, directory: Path) -> None:
+        """
+        Recorded adapter
+
+        :param directory: directory of recorded responses
+        :return: None
+        """
+        super().__init__()
+        self.directory = directory
+        self.pages: Counter = Counter()  # Pages requested per ResumptionToken
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ,unused-argument
+        """
+        Return the recorded response for the request
+
+        :param request: PreparedRequest
+        :return: Response
+        """
+        file = self.directory / recording_name(request, self.pages)  # Find the recorded response
+        response = requests.Response()  # Create the response
+        response.request = request
+        response.url = request.url
+
+        if file.exists():  # Return the recording
+            response.status_code = 200
+            response._content = file.read_bytes()  # pylint: disable=protected-access
+            response._content_consumed = True  # pylint: disable=protected-access
+        else:  # Return a not found error
+            logging.error('No recorded response: %s', file)
+            response.status_code = 404
+            response._content = b''  # pylint: disable=protected-access
+
+        return response
+
+    def close(self) -> None:
+        """
+        Close the adapter
+
+        :return: None
+        """
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Save every Alma Analytics response to a directory while passing it through
+    """
+    def __init__(self, directory: Path) -> None:
+        """
+        Recording adapter
+
+        :param directory: directory to save responses to
+        :return: None
+        """
+        super().__init__()
+        self.directory = directory
+        self.pages: Counter = Counter()  # Pages requested per ResumptionToken
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        """
+        Send the request and save the response
+
+        :param request: PreparedRequest
+        :return: Response
+        """
+        response = super().send(request, **kwargs)  # Send the request
+
+        if response.ok:  # Save successful responses
+            (self.directory / recording_name(request, self.pages)).write_bytes(response.content)
+
+        return response
+
+
+class OutboxAdapter(BaseAdapter):
+    """
+    Write webhook emails to a directory instead of sending them
+    """
+    def __init__(self, directory: Path) -> None:
+        """
+        Outbox adapter
+
+        :param directory: directory to write emails to
+        :return: None
+        """
+        super().__init__()
+        self.directory = directory
+        self.count = itertools.count(1)  # Number the emails in the order they were sent
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ,unused-argument
+        """
+        Write the email and return the webhook's created response
+
+        :param request: PreparedRequest
+        :return: Response
+        """
+        body = request.body  # Get the webhook payload
+
+        if hasattr(body, 'read'):  # Read a payload streamed from a file
+            body = body.read()
+
+        if request.headers.get('Content-Encoding') == 'gzip':  # Decompress the payload
+            body = gzip.decompress(body)
+
+        payload = json.loads(body)  # Parse the webhook payload
+        name = f"{next(self.count):04d}_{payload['to']}"  # Build the file name
+
+        (self.directory / f'{name}.json').write_bytes(body)  # Write the webhook payload
+        (self.directory / f'{name}.html').write_text(payload['body'], encoding='utf-8')  # Write the body
+
+        response = requests.Response()  # Create the response
+        response.request = request
+        response.url = request.url
+        response.status_code = 201
+        response._content = b''  # pylint: disable=protected-access
+
+        return response
+
+    def close(self) -> None:
+        """
+        Close the adapter
+
+        :return: None
+        """
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """
+    Parse the command line arguments
+
+    :param argv: list of arguments
+    :return: Namespace
+    """
+    parser = argparse.ArgumentParser(description='Run a trigger outside the Azure Functions host')
+    parser.add_argument('code', help='Azuretrigger code to run, e.g. scf_duplicate')
+    parser.add_argument('--db', help='database URL, e.g. sqlite:///local.db (defaults to SQLALCHEMY_DB_URL)')
+    parser.add_argument('--alma', type=Path, help='directory of recorded Analytics responses to serve')
+    parser.add_argument('--alma-url', help='Alma API host to use instead of the region, e.g. a fake server')
+    parser.add_argument('--record', type=Path, help='directory to save the Analytics responses to')
+    parser.add_argument('--outbox', type=Path, help='directory to write emails to instead of sending them')
+    parser.add_argument('--workers', type=int, help='analyses processed at the same time')
+    parser.add_argument('--analysis', type=int, action='append', help='only run this analysis ID, e.g. to resume')
+    parser.add_argument('--budget', type=float, help='seconds the run may take (defaults to the functionTimeout)')
+    parser.add_argument('--profile', action='store_true', help='profile the run and print the slowest calls')
+    parser.add_argument('--profile-out', type=Path, help='file to save the profile to for later inspection')
+    parser.add_argument('--verbose', action='store_true', help='log debug messages')
+
+    return parser.parse_args(argv)
+
+
+def profile_run(run: Callable[[], Any]) -> pstats.Stats:
+    """
+    Run a function under a profiler on its own thread and on every thread it starts
+
+    The pipeline's stages run on worker threads, which a profiler on the calling thread does not see.
+
+    :param run: function to run
+    :return: Stats of every thread's profile
+    """
+    profilers: list[cProfile.Profile] = []  # Profilers of the worker threads
+
+    def profile_thread(*_) -> None:  # Called on a new thread's first event, then replaced by its profiler
+        profiler = cProfile.Profile()
+        profilers.append(profiler)
+        profiler.enable()
+
+    threading.setprofile(profile_thread)  # Profile every thread the run starts
+
+    try:
+        profiler = cProfile.Profile()  # Profile the calling thread
+        profiler.runcall(run)
+    finally:
+        threading.setprofile(None)  # type:ignore[arg-type]
+
+    return pstats.Stats(profiler, *profilers, stream=sys.stderr)  # Merge the threads' profiles
+
+
+def main(argv: list[str] | None = None) -> int:
+    """
+    Run the trigger
+
+    :param argv: list of arguments
+    :return: exit code
+    """
+    args = parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(levelname)s %(message)s')
+
+    if args.db:  # The database and Alma host are read when the modules are imported
+        os.environ['SQLALCHEMY_DB_URL'] = args.db
+    if args.alma_url:
+        os.environ['ALMA_API_URL'] = args.alma_url
+
+    # pylint: disable=import-outside-toplevel
+    from controllers import build_path, get_config, http
+    from models import session_scope
+    from deadline import Deadline
+    from pipeline import run_trigger
+
+    with session_scope(readonly=True) as session:  # Create a session
+        alma = build_path(session)  # Get the Analytics API path
+        webhook = get_config('webhook_url', session)  # Get the webhook URL
+
+    if args.alma and alma:  # Serve the Analytics responses from the recordings
+        http.mount(alma, RecordedAdapter(args.alma))
+    elif args.record and alma:  # Save the Analytics responses
+        args.record.mkdir(parents=True, exist_ok=True)
+        http.mount(alma, RecordingAdapter(args.record))
+
+    if args.outbox and webhook:  # Write the emails to the outbox
+        args.outbox.mkdir(parents=True, exist_ok=True)
+        http.mount(webhook, OutboxAdapter(args.outbox))
+
+    deadline = Deadline(args.budget)  # Start the run's deadline
+    run = partial(run_trigger, args.code, workers=args.workers, deadline=deadline, analysis_ids=args.analysis)
+
+    if not args.profile and not args.profile_out:  # Run the trigger
+        run()
+        return 1 if deadline.deferred else 0
+
+    stats = profile_run(run)  # Run the trigger under the profiler
+
+    if args.profile_out:  # Save the profile
+        stats.dump_stats(args.profile_out)
+
+    if args.profile:  # Print the slowest calls
+        stats.sort_stats('cumulative').print_stats(30)
+
+    return 1 if deadline.deferred else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
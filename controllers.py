@@ -1,16 +1,47 @@
 """
 Controllers for the application.
 """
+import base64
+import csv
+import gzip
+import io
+import json
 import logging
+import os
+import tempfile
 import urllib.parse
-from bs4 import BeautifulSoup  # type:ignore[import-untyped]
+from functools import partial
+from typing import IO, Any, Iterable
 from jinja2 import Environment, FileSystemLoader, select_autoescape  # type:ignore[import-untyped]
 import requests  # type:ignore[import-untyped]
 from requests.auth import HTTPBasicAuth  # type:ignore[import-untyped]
 import sqlalchemy
 from sqlalchemy import select
-from sqlalchemy.orm import scoped_session
-from models import Analysis, Apikey, Area, Config, Report, Azuretrigger, Email
+from sqlalchemy.orm import scoped_session, selectinload
+from spill import CHUNK_SIZE, MEMORY_BUDGET, BodyFile, RowFile, get_page_status, parse_file, spool_response
+from deadline import DELIVERY_RESERVE, Deadline
+from secretstore import apikey_name, config_name, provider
+from models import Analysis, Area, Attachment, Recipient, Report, Azuretrigger, Email
+
+ATTACH_REPORTS = os.getenv('ATTACH_REPORTS', 'false').lower() == 'true'  # Needs a webhook that accepts attachments
+INLINE_ROW_LIMIT = int(os.getenv('INLINE_ROW_LIMIT', '500'))  # Largest report rendered entirely inline
+PREVIEW_ROWS = int(os.getenv('PREVIEW_ROWS', '25'))  # Rows shown inline when the report is attached instead
+COMPACT_EMAIL = os.getenv('COMPACT_EMAIL', 'true').lower() == 'true'  # Style the table once instead of every cell
+WEBHOOK_GZIP = os.getenv('WEBHOOK_GZIP', 'false').lower() == 'true'  # Compress the webhook request body
+ALMA_API_URL = os.getenv('ALMA_API_URL')  # Override the Alma API host, e.g. to point at a fake server
+
+ANALYTICS_TIMEOUT = 600  # Longest wait for an Analytics report
+ANALYTICS_PAGE_SIZE = 1000  # Rows per page of an Analytics report, the most Alma returns
+WEBHOOK_TIMEOUT = 10  # Longest wait for the webhook
+RUN_CONFIGS = ['alma_region', 'webhook_url', 'webhook_user', 'webhook_pass', 'sender_email']  # Config read per run
+HIDDEN_HEADING = '0'  # Heading of the helper columns Analytics adds to a report
+BARCODE_HEADING = os.getenv('BARCODE_HEADING', 'Barcode')  # Column heading of the barcode in the Analytics reports
+
+http = requests.Session()  # Shared HTTP session so connections are reused and transports can be swapped
+templates = Environment(  # Shared Jinja environment so each template is only compiled once
+    loader=FileSystemLoader('templates'),  # load the templates from the templates directory
+    autoescape=select_autoescape(['html', 'xml'])  # autoescape html and xml
+)
 
 
 # noinspection PyTypeChecker
@@ -32,13 +63,22 @@ def get_trigger_analyses(trigger_code: str, session: scoped_session) -> list["An
     return analyses
 
 
-def get_analysis(analysis: Analysis, session: scoped_session) -> requests.Response | None:
+def get_analysis(
+        analysis: Analysis,
+        session: scoped_session,
+        deadline: Deadline | None = None
+) -> list[tuple[IO[bytes], int]] | None:
     """
-    Get the report from Alma Analytics
+    Get every page of the report from Alma Analytics
+
+    Alma returns at most ANALYTICS_PAGE_SIZE rows per call, with a ResumptionToken on the first page. The pages are
+    requested with the token until IsFinished is true. Each page is read into a temporary file, and once the report
+    exceeds the memory budget the rest of its pages are kept on disk.
 
     :param analysis: Analysis
     :param session: Session object
-    :return: requests.Response
+    :param deadline: Deadline of the invocation; the download is deferred if it cannot finish in time
+    :return: list of (file object of the page, size of the page) or None
     """
     if not analysis:  # Check for empty parameters
         logging.error('No analysis found')
@@ -63,24 +103,125 @@ def get_analysis(analysis: Analysis, session: scoped_session) -> requests.Respon
     if not check_exception(apikey):  # Check for empty or errors
         return None
 
-    payload = {'limit': '1000', 'col_names': 'true', 'path': analysis.path, 'apikey': apikey}  # Create the payload
-    payload_str = urllib.parse.urlencode(payload, safe=':%')
-
     path = build_path(session)  # Build the API path
 
     if not check_exception(path):  # Check for empty or errors
         return None
 
-    try:  # Try to get the report from Alma
-        response = requests.get(path, params=payload_str, timeout=600)  # Get the report from Alma
+    payload = {  # Create the payload of the first page
+        'limit': str(ANALYTICS_PAGE_SIZE), 'col_names': 'true', 'path': analysis.path, 'apikey': apikey
+    }
+    pages: list[tuple[IO[bytes], int]] = []  # Create a list of pages
+    size = 0  # Count the bytes read
+
+    while True:  # Get the pages until the report is finished
+        page = get_page(path, payload, analysis, deadline)  # type:ignore[arg-type]  # Get the next page
+
+        if page is None:  # Check for errors or the deadline
+            close_pages(pages)
+            return None
+
+        pages.append(page)
+        size += page[1]
+
+        if MEMORY_BUDGET and size > MEMORY_BUDGET:  # Keep the rest of the report on disk
+            page[0].rollover()  # type:ignore[attr-defined]
+
+        status = get_page_status(page[0])  # Read whether there are more pages
+
+        if status is None:  # Check for errors
+            close_pages(pages)
+            return None
+
+        token, finished = status
+
+        if finished:  # Check for the last page
+            break
+
+        token = token or payload.get('token')  # Only the first page has the token
+
+        if not token:  # Refuse to report on part of the report
+            logging.error('Unfinished report with no ResumptionToken: %s %s', iz.code, analysis.azuretrigger.name)
+            close_pages(pages)
+            return None
+
+        payload = {'limit': str(ANALYTICS_PAGE_SIZE), 'token': token, 'apikey': apikey}  # Ask for the next page
+
+    logging.info(  # Log success
+        'API call succeeded: %s %s, %s pages', analysis.iz.code, analysis.azuretrigger.name, len(pages)
+    )
+
+    return pages
+
+
+def get_page(
+        path: str,
+        payload: dict[str, str],
+        analysis: Analysis,
+        deadline: Deadline | None = None
+) -> tuple[IO[bytes], int] | None:
+    """
+    Get one page of a report from Alma Analytics
+
+    :param path: Analytics API path
+    :param payload: query parameters of the page
+    :param analysis: Analysis
+    :param deadline: Deadline of the invocation; the download is deferred if it cannot finish in time
+    :return: (file object of the page, size of the page) or None
+    """
+    timeout = ANALYTICS_TIMEOUT  # Set the longest wait for Alma
+
+    if deadline:  # Fit the call in the time left, keeping time back for delivery
+        timeout = deadline.timeout(ANALYTICS_TIMEOUT, reserve=DELIVERY_RESERVE)  # type:ignore[assignment]
+
+        if timeout is None:  # Check for too little time left
+            deadline.defer('download', analysis.id, analysis.iz.code)
+            return None
+
+    try:  # Try to get the page from Alma
+        response = http.get(  # Get the page from Alma
+            path, params=urllib.parse.urlencode(payload, safe=':%'), timeout=timeout, stream=True
+        )
         response.raise_for_status()  # Check for HTTP errors
+        page = spool_response(response, deadline)  # Read the page, stopping at the deadline
     except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:  # Handle exceptions
         logging.error(e)
         return None
 
-    logging.info('API call succeeded: %s %s', analysis.iz.code, analysis.azuretrigger.name)  # Log success
+    if page is None:  # Check for the deadline
+        deadline.defer('download', analysis.id, analysis.iz.code)  # type:ignore[union-attr]
+
+    return page
+
+
+def close_pages(pages: list[tuple[IO[bytes], int]]) -> None:
+    """
+    Close the pages of a report
+
+    :param pages: list of (file object of the page, size of the page)
+    :return: None
+    """
+    for body, _ in pages:  # Iterate through the pages
+        body.close()
+
+
+def prefetch_secrets(analyses: list[Analysis], session: scoped_session) -> None:
+    """
+    Fetch every API key and config value a trigger run needs in one batch
+
+    :param analyses: list of Analysis
+    :param session: Session object
+    :return: None
+    """
+    area = get_area_by_name('analytics', session)  # Get the area from the database
 
-    return response
+    if not check_exception(area):  # Check for empty values or errors
+        return
+
+    names = [config_name(key) for key in RUN_CONFIGS]  # Get the config values
+    names += [apikey_name(analysis.iz_id, area.id, 0) for analysis in analyses]  # type:ignore[union-attr]
+
+    provider.prefetch(names, session)  # Cache the secrets
 
 
 def build_path(session: scoped_session) -> str | None:
@@ -90,6 +231,9 @@ def build_path(session: scoped_session) -> str | None:
     :param session: Session object
     :return: The API path.
     """
+    if ALMA_API_URL:  # Use the configured host instead of the region's
+        return ALMA_API_URL.rstrip('/') + '/almaws/v1/analytics/reports'
+
     region = get_config('alma_region', session)  # Get the region from the database
 
     if not check_exception(region):  # Check for empty or errors
@@ -112,18 +256,10 @@ def get_key(iz: int, area: int, write: int, session: scoped_session) -> str | No
     if not check_exception(iz) or not check_exception(area):  # Check for empty values
         return None
 
-    stmt = (  # Select the appropriate API key from the database
-        select(Apikey)
-        .where(Apikey.iz_id == iz)
-        .where(Apikey.area_id == area)
-        .where(Apikey.writekey == write)
-    )
+    apikey = provider.get(apikey_name(iz, area, write), session)  # Get the API key from the secret provider
 
-    try:
-        apikey = session.scalars(stmt).one().apikey  # Execute the statement and get the result
-
-    except sqlalchemy.exc.NoResultFound as e:  # Handle exceptions
-        logging.error('No API key found: %s', e)  # log the error
+    if not apikey:  # Check for empty values
+        logging.error('No API key found: %s', apikey_name(iz, area, write))  # log the error
         return None
 
     logging.debug('API key retrieved')  # Log success
@@ -168,7 +304,14 @@ def get_trigger(code: str, session: scoped_session) -> Azuretrigger | None:
         logging.error('Missing trigger code parameter')
         return None
 
-    stmt = select(Azuretrigger).where(Azuretrigger.code == code)  # Select the trigger from the database
+    stmt = (  # Select the trigger from the database with everything its analyses need to run
+        select(Azuretrigger)
+        .where(Azuretrigger.code == code)
+        .options(
+            selectinload(Azuretrigger.analyses).selectinload(Analysis.iz),
+            selectinload(Azuretrigger.analyses).selectinload(Analysis.recipients).selectinload(Recipient.user)
+        )
+    )
     try:
         trigger = session.scalars(stmt).one()  # Execute the statement and get the result
     except sqlalchemy.exc.NoResultFound as e:  # Handle exceptions
@@ -192,13 +335,10 @@ def get_config(key: str, session: scoped_session) -> str | None:
         logging.error('Missing config key parameter')
         return None
 
-    # Get the region from the database
-    stmt = select(Config).where(Config.configkey == key)  # Select the region from the database
+    config = provider.get(config_name(key), session)  # Get the config from the secret provider
 
-    try:
-        config = session.scalars(stmt).one().value  # Execute the statement and get the result
-    except sqlalchemy.exc.NoResultFound as e:  # Handle exceptions
-        logging.error('Error: %s', e)  # log the error
+    if config is None:  # Check for missing values
+        logging.error('No config found: %s', key)  # log the error
         return None
 
     logging.debug('Config retrieved: %s', key)  # Log success
@@ -206,37 +346,14 @@ def get_config(key: str, session: scoped_session) -> str | None:
     return config  # Return the region
 
 
-def send_emails(report: Report, analysis: Analysis, session: scoped_session) -> None:
-    """
-    Send the email to the analysis's recipients
-
-    :param report: Report
-    :param analysis: Analysis
-    :param session: Session object
-    :return: None
-    """
-    email = construct_email(report)  # type:ignore[arg-type] # Construct the email
-
-    if not check_exception(email):  # Check for empty or errors
-        return
-
-    recipients = analysis.recipients  # Get the analysis's recipients
-
-    if not check_exception(recipients):  # Check for empty or errors
-        return
-
-    for recipient in recipients:  # Iterate through the analysis's recipients
-
-        if not check_exception(recipient):  # Check for empty or errors
-            return
-
-        send_email(email, recipient.user.email, session)  # type:ignore[arg-type]  # Send email to recipient
-
-
 def construct_email(report: Report) -> Email | None:
     """
     Construct the email object
 
+    With ATTACH_REPORTS, reports with more than INLINE_ROW_LIMIT rows are attached as a compressed CSV and only a
+    preview of the first PREVIEW_ROWS rows is rendered in the body. The webhook must then accept the attachments field.
+    Otherwise the body of a report spilled to disk is rendered to disk as well, so it is never held in memory.
+
     :param report: Report
     :return: Email or None
     """
@@ -245,31 +362,71 @@ def construct_email(report: Report) -> Email | None:
         return None
 
     try:
-        body = render_template(  # Build the email body
-            'email.html',  # template
-            rows=report.data['data']['rows'],  # type:ignore[union-attr]  # rows
-            columns=report.data['data']['columns'],  # type:ignore[union-attr]  # columns
-            column_keys=list(report.data['data']['columns'].keys()),  # type:ignore[union-attr] # column keys
-            title=report.data['data']['report_name'].upper()  # type:ignore[union-attr]  # IZ
-        )
+        rows = report.data['data']['rows']  # type:ignore[union-attr]  # rows
+        columns = report.data['data']['columns']  # type:ignore[union-attr]  # columns
+        report_name = report.data['data']['report_name']  # type:ignore[union-attr]  # report name
     except KeyError as e:  # Handle exceptions
         logging.error(e)
         return None
 
-    try:
-        email = Email(  # Create the email object
-            subject=f"{report.data['data']['report_name']}",  # type:ignore[union-attr]  # subject
-            body=body  # body
-        )
-    except KeyError as e:  # Handle exceptions
-        logging.error(e)
-        return None
+    attachments = []  # Create a list of attachments
+
+    if ATTACH_REPORTS and len(rows) > INLINE_ROW_LIMIT:  # Check if the report is too large to send inline
+        attachments.append(build_csv_attachment(report_name, columns, rows))  # Attach the full report
+        preview = rows[:PREVIEW_ROWS]  # Only render the first rows in the body
+    else:
+        preview = rows  # Render every row in the body
+
+    body = (render_file if isinstance(preview, RowFile) else render_template)(  # Build the email body
+        'email_compact.html' if COMPACT_EMAIL else 'email.html',  # template
+        rows=preview,  # rows
+        columns=columns,  # columns
+        column_keys=list(columns.keys()),  # column keys
+        visible_keys=[key for key, heading in columns.items() if heading != HIDDEN_HEADING],  # keys of columns to show
+        title=report_name.upper(),  # IZ
+        total_rows=len(rows),  # row count
+        attachment=attachments[0].name if attachments else None  # attachment file name
+    )
+
+    email = Email(  # Create the email object
+        subject=f"{report_name}",  # subject
+        body=body,  # body
+        attachments=attachments  # attachments
+    )
 
     logging.debug('Email constructed: %s', email.subject)  # Log the email constructed
 
     return email
 
 
+def build_csv_attachment(report_name: str, columns: dict[str, str], rows) -> Attachment:
+    """
+    Write the report rows to a gzip-compressed CSV attachment
+
+    :param report_name: str
+    :param columns: dict
+    :param rows: iterable of row dictionaries
+    :return: Attachment
+    """
+    column_keys = [key for key, heading in columns.items() if heading != HIDDEN_HEADING]  # Skip hidden columns
+
+    buffer = io.BytesIO()  # Create an in-memory buffer for the compressed file
+
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as compressed:  # Compress while writing
+        with io.TextIOWrapper(compressed, encoding='utf-8', newline='') as text:  # Write text to the stream
+            writer = csv.writer(text)  # Create the CSV writer
+            writer.writerow([columns[key] for key in column_keys])  # Write the headings
+
+            for row in rows:  # Stream the rows into the file one at a time
+                writer.writerow([row.get(key, '') for key in column_keys])  # Write the row
+
+    name = report_name.lower().replace(' ', '_') + '.csv.gz'  # Build the file name
+
+    logging.debug('CSV attachment built: %s', name)  # Log the attachment built
+
+    return Attachment(name=name, content=buffer.getvalue(), content_type='application/gzip')
+
+
 def render_template(template, **kwargs) -> str:
     """
     Render a Jinja template with the variables passed in
@@ -278,18 +435,41 @@ def render_template(template, **kwargs) -> str:
     :param kwargs: dict
     :return: str
     """
-    env = Environment(  # create the environment
-        loader=FileSystemLoader('templates'),  # load the templates from the templates directory
-        autoescape=select_autoescape(['html', 'xml'])  # autoescape html and xml
-    )
-
-    template = env.get_template(template)  # get the template
+    template = templates.get_template(template)  # get the template
 
     logging.debug('Email rendered')  # log the template rendered
 
     return template.render(**kwargs)  # render the template with the variables passed in
 
 
+def render_file(template, **kwargs) -> BodyFile:
+    """
+    Render a Jinja template to a body file, a chunk at a time
+
+    :param template: str
+    :param kwargs: dict
+    :return: BodyFile
+    """
+    body = BodyFile()  # Create the file
+    buffer: list[str] = []  # Collect the small pieces the template yields
+    size = 0  # Count the characters collected
+
+    for text in templates.get_template(template).generate(**kwargs):  # Render the template piece by piece
+        buffer.append(text)
+        size += len(text)
+
+        if size >= CHUNK_SIZE:  # Write a chunk once enough has been collected
+            body.write(''.join(buffer))
+            buffer.clear()
+            size = 0
+
+    body.write(''.join(buffer))  # Write the rest
+
+    logging.debug('Email rendered: %s bytes', len(body))  # log the template rendered
+
+    return body.finish()
+
+
 def check_exception(value: object) -> bool:
     """
     Return the exception value
@@ -305,36 +485,61 @@ def check_exception(value: object) -> bool:
     return True
 
 
-# pylint: disable=r0914
-def get_report(analysis: Analysis, session: scoped_session) -> Report | None:
+def parse_report(
+        pages: list[tuple[IO[bytes], int]],
+        analysis: Analysis,
+        headings: Iterable[str] | None = None
+) -> Report | None:
     """
-    Get the report from Alma Analytics
+    Parse the pages of an Alma Analytics report into a report
 
-    :param analysis: Analysis
-    :param session: Session object
-    :return: requests.Response or None
-    """
-    if not check_exception(analysis):  # Check for empty or errors
-        return None
+    Every page is parsed as a stream with lxml, one row at a time. The rows of reports larger than the memory budget go
+    to a disk-backed row file, and those of smaller reports to a list. Only the projected columns are stored: values of
+    every other column are parsed but dropped as each row is read. The columns come from the first page.
 
-    # Get the data from Alma Analytics
-    response = get_analysis(analysis, session)
+    A report without rows gives a report with no rows. Alma errors, unparseable pages and reports lacking a projected
+    column give None.
 
-    if not check_exception(response):  # Check for empty or errors
-        return None
+    :param pages: list of (file object of the page, size of the page)
+    :param analysis: Analysis
+    :param headings: headings of the columns to keep, defaults to every column that is not hidden
+    :return: Report, or None if the report could not be parsed
+    """
+    size = sum(page_size for _, page_size in pages)  # Get the size of the report
+    columns: dict[str, str] | None = None  # Columns of the first page
+    rows: RowFile | list[dict[str, str]] = []  # Keep the rows of a small report in memory
 
-    soup = get_soup(response)  # Parse the XML response
+    if MEMORY_BUDGET and size > MEMORY_BUDGET:  # Keep the rows of a large report on disk
+        logging.info('Report of %s bytes exceeds the memory budget, spilling to disk', size)
+        rows = RowFile()
 
-    if not check_exception(soup):  # Check for empty or errors
+    try:
+        for body, _ in pages:  # Stream the rows of every page
+            columns = parse_file(body, rows, partial(project_columns, headings=headings), columns)
+
+            if columns is None:  # Check for errors
+                if isinstance(rows, RowFile):  # Remove the row file
+                    rows.close()
+                return None
+    finally:
+        close_pages(pages)
+
+    if isinstance(rows, RowFile):  # Map the rows for reading
+        rows.finish()
+
+    missing = set(headings or []) - set((columns or {}).values())  # Get the projected columns the report lacks
+
+    if not columns or missing:  # Check for a report without the columns the stages need
+        logging.error(
+            'Report %s %s is missing columns: %s',
+            analysis.iz.code,
+            analysis.azuretrigger.name,
+            ', '.join(sorted(missing)) or 'all'
+        )
+        if isinstance(rows, RowFile):  # Remove the row file
+            rows.close()
         return None
 
-    columns = get_columns(soup)  # type: ignore # Get the columns from the XML response
-    rows = get_rows(soup)  # type: ignore # Get the rows from the XML response
-
-    for i in [columns, rows]:  # Iterate through the columns and rows
-        if not check_exception(i):  # Check for empty or errors
-            return None
-
     report = Report(  # Create the report object
         data={
             'status': 'success',
@@ -342,7 +547,8 @@ def get_report(analysis: Analysis, session: scoped_session) -> Report | None:
             'data': {
                 'report_name': analysis.iz.code.upper() + ' ' + analysis.azuretrigger.name,
                 'columns': columns,
-                'rows': rows
+                'rows': rows,
+                'bytes': size
             }
         }
     )
@@ -352,114 +558,133 @@ def get_report(analysis: Analysis, session: scoped_session) -> Report | None:
     return report  # Return the report
 
 
-def get_soup(response) -> BeautifulSoup | None:
+def project_columns(columns: dict[str, str], headings: Iterable[str] | None = None) -> dict[str, str]:
     """
-    Parse the XML response
+    Keep the columns a report needs, with readable headings
 
-    :param response: requests.Response
-    :return: BeautifulSoup
+    :param columns: dict of column name to raw heading
+    :param headings: headings of the columns to keep, defaults to every column that is not hidden
+    :return: dict of column name to heading
     """
-    if not check_exception(response):  # Check for empty or errors
-        return None
+    columns = {name: clean_heading(heading) for name, heading in columns.items()}  # Clean the headings
 
-    soup = BeautifulSoup(response.content, 'xml')  # Parse the XML response
+    if headings is None:  # Keep every column that is not hidden
+        return {name: heading for name, heading in columns.items() if heading != HIDDEN_HEADING}
 
-    if not check_exception(soup):  # Check for empty or errors
-        return None  # Return the error or None
+    wanted = set(headings)  # Keep the declared columns
 
-    if soup.find('error'):  # Check for Alma errors
-        logging.error('Error: %s', soup.find('error').text)  # type: ignore
-        return None
+    return {name: heading for name, heading in columns.items() if heading in wanted}
 
-    logging.debug('XML response parsed')  # Log the success message
-
-    return soup
 
+def clean_heading(heading: str) -> str:
+    """
+    Replace Analytics formula headings with a readable name
 
-def get_columns(soup: BeautifulSoup) -> dict[str, str] | None:  # type:ignore[valid-type]
+    :param heading: column heading
+    :return: str
     """
-    Get the data rows from the report
+    if 'CASE  WHEN Provenance Code' in heading:  # If column is Provenance Code
+        return 'Provenance Code'  # Change column name to Provenance Code
+
+    return heading
 
-    :param soup: BeautifulSoup
-    :return: list or None
+
+def write_payload(payload: dict[str, Any], body: BodyFile) -> IO[bytes]:
     """
-    if not check_exception(soup):  # Check for empty or errors
-        return None
+    Write the webhook payload to a temporary file, streaming the body in after the other fields
 
-    columnlist = soup.find_all('xsd:element')  # Get the columns from the XML response
+    :param payload: dict of the other fields, with an empty body
+    :param body: BodyFile
+    :return: file object positioned at the start of the payload
+    """
+    fields = {key: value for key, value in payload.items() if key != 'body'}  # Put the body last
+    file = tempfile.TemporaryFile()  # pylint: disable=consider-using-with  # Closed once sent
+    out: IO[bytes] = file  # Write the payload to the file
 
-    if not check_exception(columnlist):
-        return None
+    if WEBHOOK_GZIP:  # Compress while writing
+        out = gzip.GzipFile(fileobj=file, mode='wb', mtime=0)  # type:ignore[assignment]
 
-    columns = {}  # Create a dictionary of columns
+    out.write(json.dumps({**fields, 'body': ''})[:-2].encode('utf-8'))  # Write the fields up to the body's value
 
-    for column in columnlist:  # Iterate through the columns
-        columns[column['name']] = column['saw-sql:columnHeading']  # type: ignore # Add column to dictionary
+    for chunk in body.chunks():  # Copy the escaped body a chunk at a time
+        out.write(chunk)
 
-        if 'CASE  WHEN Provenance Code' in columns[column['name']]:  # type: ignore # If column is Provenance Code
-            columns[column['name']] = 'Provenance Code'  # type: ignore # Change column name to Provenance Code
+    out.write(b'"}')  # Close the body and the payload
 
-    logging.debug('Columns retrieved')  # Log the success message
+    if out is not file:  # Finish the compressed stream
+        out.close()
 
-    return columns  # type: ignore # Return the dictionary of columns
+    file.seek(0)  # Rewind for sending
 
+    return file
 
-def get_rows(soup: BeautifulSoup) -> list | None:  # type:ignore[valid-type]
-    """
-    Get the data rows from the report
 
-    :param soup: BeautifulSoup
-    :return: list or None
+def send_email(email: Email, to: str, session: scoped_session, deadline: Deadline | None = None) -> bool:
     """
-    if not check_exception(soup):  # Check for empty or errors
-        return None
-
-    rowlist = soup.find_all('Row')  # Get the rows from the XML response
+            Send the email to webhook
 
-    if not check_exception(rowlist):
-        return None
+            :param deadline: Deadline of the invocation; the email is not sent if it cannot be sent in time
+            :return: True if the email was sent, False if there was no time left to send it
+            """
+    # Create the basic auth object
+    basic = HTTPBasicAuth(get_config('webhook_user', session), get_config('webhook_pass', session))
 
-    rows = []  # Create a list of rows
+    payload: dict[str, Any] = {  # Build the webhook payload
+        "subject": email.subject,
+        "body": email.body if isinstance(email.body, str) else '',
+        "to": to,
+        "sender": get_config('sender_email', session)
+    }
+
+    if email.attachments:  # Add the attachments as base64 content
+        payload['attachments'] = [
+            {
+                "name": attachment.name,
+                "contentType": attachment.content_type,
+                "contentBytes": base64.b64encode(attachment.content).decode('ascii')
+            }
+            for attachment in email.attachments
+        ]
 
-    for value in rowlist:  # Iterate through the rows
-        values = {}  # Create a dictionary of values
-        kids = value.findChildren()  # type: ignore # Get the children of the row
+    headers = {'Content-Type': 'application/json'}  # Create the request headers
 
-        for kid in kids:  # Iterate through the children
-            values[kid.name] = kid.text  # Add the child to the dictionary
+    if WEBHOOK_GZIP:  # Mark the payload as compressed
+        headers['Content-Encoding'] = 'gzip'
 
-        rows.append(values)  # Add the dictionary to the list
+    if isinstance(email.body, BodyFile):  # Stream a body rendered to disk
+        data: bytes | IO[bytes] = write_payload(payload, email.body)
+    else:
+        data = json.dumps(payload).encode('utf-8')  # Encode the payload
 
-    logging.debug('Rows retrieved')  # Log the success message
+        if WEBHOOK_GZIP:  # Compress the payload
+            data = gzip.compress(data, mtime=0)
 
-    return rows  # Return the list of rows
+    timeout = WEBHOOK_TIMEOUT  # Set the longest wait for the webhook
 
+    if deadline:  # Fit the call in the time left
+        timeout = deadline.timeout(WEBHOOK_TIMEOUT)  # type:ignore[assignment]
 
-def send_email(email: Email, to: str, session: scoped_session) -> None:
-    """
-            Send the email to webhook
+        if timeout is None:  # Check for too little time left
+            if not isinstance(data, bytes):  # Remove the payload file
+                data.close()
 
-            :return: None
-            """
-    # Create the basic auth object
-    basic = HTTPBasicAuth(get_config('webhook_user', session), get_config('webhook_pass', session))
+            return False
 
     try:  # Try to send the email
-        response = requests.post(  # Send the email
+        response = http.post(  # Send the email
             url=get_config('webhook_url', session),
-            json={
-                "subject": email.subject,
-                "body": email.body,
-                "to": to,
-                "sender": get_config('sender_email', session)
-            },
-            timeout=10,
+            data=data,
+            headers=headers,
+            timeout=timeout,
             auth=basic
         )
 
     except requests.exceptions.RequestException as e:  # Handle request exceptions
         logging.error('Error: %s', e)  # If there is an error, log it
         raise  # If there is an error, raise it
+    finally:
+        if not isinstance(data, bytes):  # Remove the payload file
+            data.close()
 
     if response.status_code != 201:  # Check if the response status code is not 201
         logging.error('Error: %s: %s', response.status_code, response.text)  # If not, log error
@@ -468,3 +693,5 @@ def send_email(email: Email, to: str, session: scoped_session) -> None:
         )
 
     logging.info('Email sent to %s: %s', to, email.subject)
+
+    return True
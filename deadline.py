@@ -0,0 +1,96 @@
+"""
+Per-invocation deadline derived from the functionTimeout in host.json.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+HOST_JSON = Path(__file__).parent / 'host.json'  # Azure Functions host configuration
+DELIVERY_RESERVE = float(os.getenv('DELIVERY_RESERVE', '60'))  # Seconds kept back from downloads for delivery
+SAFETY_MARGIN = float(os.getenv('DEADLINE_MARGIN', '15'))  # Seconds kept back for the host to finish the invocation
+MIN_TIMEOUT = float(os.getenv('MIN_TIMEOUT', '2'))  # Shortest timeout worth starting a network call with
+
+
+def get_function_timeout() -> float:
+    """
+    Get the functionTimeout from host.json in seconds
+
+    :return: float
+    """
+    try:
+        with open(HOST_JSON, encoding='utf-8') as file:
+            timeout = json.load(file).get('functionTimeout', '00:10:00')  # Get the timeout as hh:mm:ss
+    except (OSError, ValueError) as e:  # Handle exceptions
+        logging.error('Error: %s', e)
+        timeout = '00:10:00'
+
+    hours, minutes, seconds = timeout.split(':')  # Split the timeout
+
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+class Deadline:
+    """
+    Deadline object
+    """
+    def __init__(self, budget: float | None = None) -> None:
+        """
+        Deadline object
+
+        :param budget: seconds from now, defaults to the functionTimeout less the safety margin
+        :return: None
+        """
+        if budget is None:
+            budget = get_function_timeout() - SAFETY_MARGIN
+
+        self.expires = time.monotonic() + budget  # Time the work must be finished by
+        self.deferred: list[tuple[str, int | None, str]] = []  # Work not started: (stage, analysis ID, detail)
+        self.lock = threading.Lock()  # Pipeline workers share the deadline
+
+    def remaining(self) -> float:
+        """
+        Get the seconds left before the deadline
+
+        :return: float
+        """
+        return self.expires - time.monotonic()
+
+    def timeout(self, limit: float, reserve: float = 0) -> float | None:
+        """
+        Get the timeout for a network call from the time left
+
+        :param limit: longest timeout the call should have
+        :param reserve: seconds to keep back for later work
+        :return: timeout in seconds, or None if there is not enough time left to start the call
+        """
+        timeout = min(limit, self.remaining() - reserve)  # Fit the call inside the time left
+
+        if timeout < MIN_TIMEOUT:  # Check for too little time left
+            return None
+
+        return timeout
+
+    def defer(self, stage: str, analysis: int | None, detail: str = '') -> None:
+        """
+        Record work that was not started so it can be resumed
+
+        :param stage: stage that was skipped
+        :param analysis: Analysis ID, if known
+        :param detail: e.g. the recipient of a skipped delivery
+        :return: None
+        """
+        with self.lock:
+            self.deferred.append((stage, analysis, detail))
+
+        logging.warning('Deferred %s of analysis %s %s: %.1fs left', stage, analysis, detail, self.remaining())
+
+    def __str__(self) -> str:
+        """
+        Return the deadline as a string
+
+        :return: str
+        """
+        return f"{self.remaining():.1f}s left, {len(self.deferred)} deferred"
@@ -0,0 +1,196 @@
+"""
+Local duplicate barcode detection across IZ reports.
+
+Each scf_duplicate analysis must point at a full barcode extract of its IZ: every item's barcode, in a column headed
+BARCODE_HEADING, not a report that is already filtered to duplicates. Barcodes shared with other IZs can only be found
+when every IZ's items are compared. Every page of each extract is downloaded, so the whole extract is compared; an
+extract Alma does not finish is left out of the run rather than compared in part.
+
+Each IZ is emailed one row per duplicate barcode it holds, with the columns Barcode, Scope, IZs and Items. The
+email does not include the Analytics item columns (title, location and so on).
+"""
+import argparse
+import logging
+import random
+import time
+from typing import Iterable, Iterator
+from controllers import BARCODE_HEADING
+from models import Analysis, Report
+
+
+class Duplicates:  # pylint: disable=too-few-public-methods
+    """
+    Duplicates object
+    """
+    def __init__(self, within: dict[str, dict[str, int]], across: dict[str, dict[str, int]]) -> None:
+        """
+        Duplicates object
+
+        :param within: dict of barcode to items per IZ code, for barcodes repeated inside at least one IZ
+        :param across: dict of barcode to items per IZ code, for barcodes shared by more than one IZ
+        :return: None
+        """
+        self.within = within
+        self.across = across
+
+    def __str__(self) -> str:
+        """
+        Return the duplicates as a string
+
+        :return: str
+        """
+        return f"{len(self.within)} within IZ, {len(self.across)} across IZs"
+
+
+def find_duplicates(pairs: Iterable[tuple[str, str]]) -> Duplicates:
+    """
+    Find duplicate barcodes in a single pass over (barcode, IZ code) pairs
+
+    The index keeps one entry per distinct barcode holding the IZ it was first seen in. Only barcodes seen again are
+    copied to the collision index, which counts the items per IZ, so memory stays proportional to the number of
+    distinct barcodes.
+
+    :param pairs: iterable of (barcode, IZ code)
+    :return: Duplicates
+    """
+    seen: dict[str, str] = {}  # Create the index of barcode to first IZ
+    collisions: dict[str, dict[str, int]] = {}  # Create the index of barcode to items per IZ
+    izs: dict[str, str] = {}  # Share one string per IZ code across the index
+
+    for barcode, iz in pairs:  # Iterate through the barcodes
+        if not barcode:  # Skip empty barcodes
+            continue
+
+        iz = izs.setdefault(iz, iz)  # Reuse the shared IZ code
+        first = seen.get(barcode)  # Get the IZ the barcode was first seen in
+
+        if first is None:  # First time the barcode is seen
+            seen[barcode] = iz
+        elif barcode in collisions:  # Barcode has already collided
+            counts = collisions[barcode]
+            counts[iz] = counts.get(iz, 0) + 1
+        elif first == iz:  # First collision for the barcode, inside the IZ
+            collisions[barcode] = {iz: 2}
+        else:  # First collision for the barcode, across IZs
+            collisions[barcode] = {first: 1, iz: 1}
+
+    within = {}  # Create the dictionary of duplicates inside one IZ
+    across = {}  # Create the dictionary of duplicates across IZs
+
+    for barcode, counts in collisions.items():  # Sort the collisions by scope
+        if len(counts) > 1:  # Barcode is held by more than one IZ
+            across[barcode] = counts
+
+        if max(counts.values()) > 1:  # Barcode is repeated inside at least one IZ
+            within[barcode] = counts
+
+    duplicates = Duplicates(within=within, across=across)  # Create the duplicates object
+
+    logging.debug('Duplicates found: %s', duplicates)  # Log the success message
+
+    return duplicates
+
+
+def get_barcodes(report: Report, iz: str) -> Iterator[tuple[str, str]]:
+    """
+    Stream the (barcode, IZ code) pairs from a report
+
+    :param report: Report
+    :param iz: IZ code
+    :return: iterator of (barcode, IZ code)
+    """
+    columns = report.data['data']['columns']  # Get the columns from the report
+    keys = [key for key, heading in columns.items() if heading == BARCODE_HEADING]  # Find the barcode column
+
+    if not keys:  # Check for a missing barcode column
+        logging.error('No %s column in report %s', BARCODE_HEADING, report.data['data']['report_name'])
+        return
+
+    for row in report.data['data']['rows']:  # Iterate through the rows
+        yield row.get(keys[0], '').strip(), iz
+
+
+def get_duplicates_report(duplicates: Duplicates, analysis: Analysis) -> Report | None:
+    """
+    Build a report of the duplicates involving the analysis's IZ
+
+    :param duplicates: Duplicates
+    :param analysis: Analysis
+    :return: Report or None
+    """
+    code = analysis.iz.code  # Get the IZ code
+    rows = []  # Create a list of rows
+
+    for barcode, counts in duplicates.within.items():  # Report barcodes the IZ itself holds more than once
+        if counts.get(code, 0) > 1:
+            rows.append({
+                'Column0': barcode,
+                'Column1': 'Within IZ',
+                'Column2': code.upper(),
+                'Column3': str(counts[code])
+            })
+
+    for barcode, counts in duplicates.across.items():  # Report barcodes the IZ shares with other IZs
+        if code in counts:
+            rows.append({
+                'Column0': barcode,
+                'Column1': 'Across IZs',
+                'Column2': ', '.join(sorted(iz.upper() for iz in counts)),
+                'Column3': str(sum(counts.values()))
+            })
+
+    if not rows:  # Check for empty results
+        return None
+
+    return Report(  # Create the report object
+        data={
+            'status': 'success',
+            'message': 'Duplicates found',
+            'data': {
+                'report_name': code.upper() + ' ' + analysis.azuretrigger.name,
+                'columns': {
+                    'Column0': BARCODE_HEADING,
+                    'Column1': 'Scope',
+                    'Column2': 'IZs',
+                    'Column3': 'Items'
+                },
+                'rows': rows
+            }
+        }
+    )
+
+
+def benchmark(count: int, izs: int, ratio: float) -> None:
+    """
+    Time find_duplicates over generated barcodes
+
+    :param count: number of barcodes
+    :param izs: number of IZs
+    :param ratio: share of barcodes that repeat an earlier barcode
+    :return: None
+    """
+    codes = [f'iz{i}' for i in range(izs)]  # Create the IZ codes
+    rng = random.Random(0)  # Seed the generator so runs are comparable
+    pairs: list[tuple[str, str]] = []  # Create the list of pairs
+
+    for i in range(count):  # Generate the barcodes
+        if i and rng.random() < ratio:  # Repeat an earlier barcode
+            pairs.append((pairs[rng.randrange(i)][0], rng.choice(codes)))
+        else:
+            pairs.append((f'3{i:013d}X', rng.choice(codes)))
+
+    start = time.perf_counter()  # Start the timer
+    duplicates = find_duplicates(pairs)  # Find the duplicates
+    elapsed = time.perf_counter() - start  # Stop the timer
+
+    print(f'{count} barcodes in {izs} IZs: {duplicates} in {elapsed:.2f}s ({count / elapsed:,.0f} barcodes/s)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark local duplicate barcode detection')
+    parser.add_argument('--count', type=int, default=5_000_000, help='number of barcodes')
+    parser.add_argument('--izs', type=int, default=20, help='number of IZs')
+    parser.add_argument('--ratio', type=float, default=0.01, help='share of duplicated barcodes')
+    args = parser.parse_args()
+
+    benchmark(args.count, args.izs, args.ratio)
@@ -0,0 +1,315 @@
+"""
+Run ledger: per-analysis metrics of each run, and slot planning from their history.
+"""
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Iterable
+from sqlalchemy import or_, select, update
+from sqlalchemy.orm import Session, scoped_session
+from deadline import DELIVERY_RESERVE, SAFETY_MARGIN, Deadline, get_function_timeout
+from models import Analysis, Run, RunAnalysis
+
+SLOT_FILL = float(os.getenv('SLOT_FILL', '0.5'))  # Share of the functionTimeout a slot is planned to fill
+DEFAULT_ESTIMATE = float(os.getenv('DEFAULT_ESTIMATE', '60'))  # Seconds assumed for an analysis with no history
+HISTORY_RUNS = int(os.getenv('HISTORY_RUNS', '3'))  # Recent runs of an analysis averaged for its estimate
+RESUME_WINDOW = timedelta(hours=float(os.getenv('RESUME_WINDOW_HOURS', '24')))  # Age after which runs are not resumed
+LEASE = timedelta(seconds=get_function_timeout())  # Age after which a claimed slot's invocation has been stopped
+
+FINISHED = ('sent', 'empty')  # Outcomes of analyses that ran to the end
+UNFINISHED = ('pending', 'deferred')  # Outcomes of analyses still to run
+RUNNING = 'running'  # Outcome of analyses claimed by the invocation running their slot
+SEVERITY = {'empty': 0, 'sent': 1, 'failed': 2}  # Order in which outcomes replace each other
+
+
+class Ledger:
+    """
+    Collect the metrics of each analysis while the pipeline runs
+    """
+    def __init__(self) -> None:
+        """
+        Ledger
+
+        :return: None
+        """
+        self.entries: dict[int, dict] = {}  # Analysis ID to metrics
+        self.lock = threading.Lock()  # Pipeline workers share the ledger
+
+    def record(self, analysis: int, **values) -> None:
+        """
+        Record metrics of an analysis, timing it from the first record to the last
+
+        An outcome only replaces a less severe one, so one failed delivery marks the analysis failed.
+
+        :param analysis: Analysis ID
+        :param values: rows, bytes or outcome (empty, sent or failed)
+        :return: None
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.entries.setdefault(analysis, {'started': datetime.now(), 'start': now, 'outcome': None})
+
+            if entry['outcome'] and SEVERITY[values.get('outcome', 'empty')] < SEVERITY[entry['outcome']]:
+                values.pop('outcome', None)  # Keep the more severe outcome
+
+            entry.update(values)
+            entry['end'] = now
+
+    def defer(self, analysis: int, to: str, subject: str) -> None:
+        """
+        Record a delivery left for a later slot, so only the recipients still waiting are sent the email on resume
+
+        :param analysis: Analysis ID
+        :param to: recipient address
+        :param subject: email subject
+        :return: None
+        """
+        with self.lock:
+            entry = self.entries.setdefault(
+                analysis, {'started': datetime.now(), 'start': time.monotonic(), 'outcome': None}
+            )
+            entry.setdefault('deliveries', []).append([to, subject])
+
+    def save(self, run: Run, claimed: Iterable[int], deadline: Deadline, session: Session) -> None:
+        """
+        Write the metrics to the analyses of the run's claimed slot and update the run's outcome
+
+        An analysis whose download was deferred keeps the deliveries it was still waiting for, if any.
+
+        :param run: Run
+        :param claimed: IDs of the analyses claimed by this invocation
+        :param deadline: Deadline with the deferred work
+        :param session: Session object
+        :return: None
+        """
+        deferred = {analysis for _, analysis, _ in deadline.deferred if analysis is not None}
+        claimed = set(claimed)
+
+        for run_analysis in run.run_analyses:  # Iterate through the run's analyses
+            if run_analysis.analysis_id not in claimed:  # Skip the analyses of other slots
+                continue
+
+            entry = self.entries.get(run_analysis.analysis_id)
+
+            if run_analysis.analysis_id in deferred:  # Work left for a later slot
+                run_analysis.outcome = 'deferred'
+
+                if entry and entry.get('deliveries'):  # Record the recipients still waiting
+                    run_analysis.deliveries = json.dumps(entry['deliveries'])
+            else:  # Work done in this slot; an analysis that never parsed failed to download
+                run_analysis.outcome = (entry and entry['outcome']) or 'failed'
+                run_analysis.deliveries = None
+
+            if entry:  # Record the metrics
+                run_analysis.started = entry['started']
+                run_analysis.duration = entry['end'] - entry['start']
+                run_analysis.rows = entry.get('rows')
+                run_analysis.bytes = entry.get('bytes')
+
+        unfinished = any(run_analysis.outcome in UNFINISHED for run_analysis in run.run_analyses)
+
+        run.outcome = 'partial' if unfinished else 'complete'
+        run.finished = datetime.now()
+
+        session.commit()  # Save the run
+
+        logging.info('Run %s %s: %s analyses recorded', run.id, run.outcome, len(self.entries))  # Log the run
+
+
+def get_estimates(analyses: list[Analysis], session: Session) -> dict[int, float]:
+    """
+    Estimate each analysis's duration from its recent finished runs
+
+    :param analyses: list of Analysis
+    :param session: Session object
+    :return: dict of Analysis ID to seconds
+    """
+    stmt = (  # Select the finished runs of the analyses, newest first
+        select(RunAnalysis)
+        .where(RunAnalysis.analysis_id.in_([analysis.id for analysis in analyses]))
+        .where(RunAnalysis.outcome.in_(FINISHED))
+        .where(RunAnalysis.duration.is_not(None))
+        .order_by(RunAnalysis.id.desc())
+    )
+
+    history: dict[int, list[float]] = {}  # Analysis ID to recent durations
+
+    for run_analysis in session.scalars(stmt):  # Keep the most recent runs of each analysis
+        durations = history.setdefault(run_analysis.analysis_id, [])
+
+        if len(durations) < HISTORY_RUNS:
+            durations.append(run_analysis.duration)  # type:ignore[arg-type]
+
+    return {analysis: statistics.mean(durations) for analysis, durations in history.items()}
+
+
+def plan_slots(analyses: list[Analysis], estimates: dict[int, float], capacity: float) -> list[list[Analysis]]:
+    """
+    Split the analyses into slots that each fit the capacity, longest analyses first
+
+    :param analyses: list of Analysis
+    :param estimates: dict of Analysis ID to seconds
+    :param capacity: seconds of work a slot can hold
+    :return: list of slots of Analysis
+    """
+    default = statistics.median(estimates.values()) if estimates else DEFAULT_ESTIMATE  # Estimate unknown analyses
+    slots: list[list[Analysis]] = []  # Create a list of slots
+    loads: list[float] = []  # Create a list of planned seconds per slot
+
+    for analysis in sorted(analyses, key=lambda item: estimates.get(item.id, default), reverse=True):
+        estimate = estimates.get(analysis.id, default)  # Get the analysis's estimate
+        slot = next((i for i, load in enumerate(loads) if load + estimate <= capacity), None)  # Find a slot with room
+
+        if slot is None:  # Open a new slot
+            slots.append([])
+            loads.append(0)
+            slot = len(slots) - 1
+
+        slots[slot].append(analysis)
+        loads[slot] += estimate
+
+    logging.debug('Slots planned: %s', [round(load) for load in loads])  # Log the plan
+
+    return slots
+
+
+def start_run(
+        trigger: int,
+        analyses: list[Analysis],
+        workers: int,
+        split: bool,
+        session: Session
+) -> tuple[Run, list[Analysis]]:
+    """
+    Record a new run with its analyses planned into slots
+
+    :param trigger: Trigger ID
+    :param analyses: list of Analysis
+    :param workers: Analytics downloads at the same time
+    :param split: whether the analyses may be split across slots
+    :param session: Session object
+    :return: (Run, analyses of the first slot)
+    """
+    capacity = (get_function_timeout() - SAFETY_MARGIN - DELIVERY_RESERVE) * SLOT_FILL * workers  # Work per slot
+    slots = plan_slots(analyses, get_estimates(analyses, session), capacity) if split else [analyses]
+
+    run = Run(azuretrigger_id=trigger, started=datetime.now(), slots=len(slots), outcome='running')
+
+    for slot, planned in enumerate(slots):  # Record the planned analyses, claiming the first slot
+        for analysis in planned:
+            run.run_analyses.append(RunAnalysis(
+                analysis_id=analysis.id,
+                slot=slot,
+                started=run.started if slot == 0 else None,
+                outcome=RUNNING if slot == 0 else 'pending'
+            ))
+
+    session.add(run)  # Save the run
+    session.commit()
+
+    if len(slots) > 1:  # Log the split
+        logging.info('Run %s split into %s slots of %s analyses', run.id, len(slots), [len(slot) for slot in slots])
+
+    return run, slots[0]
+
+
+def get_pending(session: Session | scoped_session) -> list[tuple[Run, list[int]]]:
+    """
+    Get the next slot of analyses of every recent run with work left
+
+    Runs with a slot in flight are skipped. A slot claimed longer ago than the functionTimeout was stopped by the
+    host, so its analyses are run again.
+
+    :param session: Session object
+    :return: list of (Run, Analysis IDs)
+    """
+    stmt = (  # Select the recent runs with work left
+        select(Run)
+        .where(Run.started >= datetime.now() - RESUME_WINDOW)
+        .where(Run.outcome.in_(('running', 'partial')))
+        .order_by(Run.started)
+    )
+
+    expired = datetime.now() - LEASE  # Claims older than this have been abandoned
+    pending = []  # Create a list of pending work
+
+    for run in session.scalars(stmt):  # Iterate through the runs
+        claimed = [item for item in run.run_analyses if item.outcome == RUNNING]
+
+        if any(item.started and item.started >= expired for item in claimed):  # Check for a slot in flight
+            continue
+
+        unfinished = [item for item in run.run_analyses if item.outcome in UNFINISHED] + claimed
+
+        if not unfinished:  # Check for nothing left
+            continue
+
+        slot = min(item.slot for item in unfinished)  # Get the next slot
+        pending.append((run, [item.analysis_id for item in unfinished if item.slot == slot]))
+
+    return pending
+
+
+def resume_run(
+        run_id: int,
+        analyses: list[Analysis],
+        analysis_ids: list[int],
+        split: bool,
+        session: Session
+) -> tuple[Run | None, list[Analysis], dict[int, set[tuple[str, str]] | None]]:
+    """
+    Claim a slot of a recorded run and get the analyses to run and the deliveries to make
+
+    Each analysis is claimed with its own update, so an invocation only runs the analyses no other invocation has
+    claimed since get_pending. A run that cannot be split runs every analysis, since its reports are combined, but
+    only delivers the reports of the claimed analyses.
+
+    :param run_id: Run ID
+    :param analyses: list of the trigger's Analysis
+    :param analysis_ids: IDs of the analyses of the slot to claim
+    :param split: whether the analyses may be split across slots
+    :param session: Session object
+    :return: (Run, analyses to run, dict of claimed Analysis ID to the [recipient, subject] pairs still to send, or
+        None to send to every recipient)
+    """
+    now = datetime.now()
+    claimed = []  # Create a list of claimed Analysis IDs
+
+    for analysis_id in analysis_ids:  # Claim each analysis unless it is finished or claimed by a live invocation
+        result = session.execute(
+            update(RunAnalysis)
+            .where(RunAnalysis.run_id == run_id)
+            .where(RunAnalysis.analysis_id == analysis_id)
+            .where(or_(
+                RunAnalysis.outcome.in_(UNFINISHED),
+                (RunAnalysis.outcome == RUNNING) & (RunAnalysis.started < now - LEASE)
+            ))
+            .values(outcome=RUNNING, started=now)
+        )
+
+        if result.rowcount:  # type:ignore[attr-defined]
+            claimed.append(analysis_id)
+
+    session.commit()  # Save the claims
+
+    if not claimed:  # Check for a slot claimed by another invocation
+        logging.info('Run %s: slot already claimed', run_id)
+        return None, [], {}
+
+    run = session.get(Run, run_id)  # Get the run with its claims
+
+    deliveries = {  # Get the recipients still waiting for each claimed analysis
+        item.analysis_id: {(pair[0], pair[1]) for pair in json.loads(item.deliveries)} if item.deliveries else None
+        for item in run.run_analyses  # type:ignore[union-attr]
+        if item.analysis_id in claimed
+    }
+
+    ids = claimed if split else [item.analysis_id for item in run.run_analyses]  # type:ignore[union-attr]
+    analyses = [analysis for analysis in analyses if analysis.id in ids]  # Get the analyses to run
+
+    return run, analyses, deliveries
@@ -0,0 +1,449 @@
+"""
+Load test of a full trigger run against a fake Alma server, with throughput, memory and wall-clock limits.
+
+A temporary SQLite database is seeded with --izs IZs, each with an API key, a user and one analysis of the trigger
+sent to that user. A fake server in a separate process serves every Analytics report of --rows rows the way Alma
+does: in pages of at most 1000 rows, the first after --latency seconds with a ResumptionToken, and each later one
+after --page-latency seconds. It also accepts the webhook's emails.
+
+The trigger then runs as it would in production, with the shipped settings: its timer starts the run, which is
+planned into slots from the analyses' estimates, and the resume timer runs the remaining slots one invocation at a
+time until no work is left. The run fails with exit code 1 if any limit is missed:
+    python loadtest.py --izs 200 --rows 20000
+    python loadtest.py --izs 50 --rows 5000 --latency 0.5 --max-rss 512 --min-rows-per-second 10000
+
+Every invocation must finish within the functionTimeout in host.json, every analysis must finish and no work may be
+left. Throughput is the rows of every report over the time spent in all the invocations; the waits between resume
+timers are not counted.
+
+The number of emails expected is worked out from the generated reports, except for triggers that combine their
+reports, whose emails are not checked.
+"""
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import Counter
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+import requests  # type:ignore[import-untyped]
+
+PATTERN_ROWS = 30  # Rows after which build_report's findings repeat
+DEFAULT_LIMIT = 25  # Rows per page when the request has no limit, as in Alma
+MAX_LIMIT = 1000  # Most rows Alma returns per page
+RESULT = (  # Analytics response around a page of rows
+    b'<report><QueryResult>%s<IsFinished>%s</IsFinished><ResultXml>'
+    b'<rowset xmlns="urn:schemas-microsoft-com:xml-analysis:rowset">%s%s</rowset></ResultXml></QueryResult></report>'
+)
+SCHEMA = (  # Columns of the report, with a hidden column as Analytics adds one; only the first page has them
+    b'<xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:saw-sql="urn:saw-sql">'
+    b'<xsd:complexType name="Row"><xsd:sequence>'
+    b'<xsd:element name="Column0" saw-sql:columnHeading="0"/>'
+    b'<xsd:element name="Column1" saw-sql:columnHeading="Barcode"/>'
+    b'<xsd:element name="Column2" saw-sql:columnHeading="Internal Note 1"/>'
+    b'<xsd:element name="Column3" saw-sql:columnHeading="Title"/>'
+    b'</xsd:sequence></xsd:complexType></xsd:schema>'
+)
+
+
+def build_report(iz: str, count: int, start: int = 0, token: str | None = None, finished: bool = True) -> bytes:
+    """
+    Generate a page of an Analytics response for an IZ
+
+    Every tenth barcode has no X and every third row has no row tray, so the checks have something to report.
+
+    :param iz: IZ code
+    :param count: number of rows in the page
+    :param start: number of the page's first row; the first page, from row 0, has the schema
+    :param token: ResumptionToken of the first page of a report with more pages
+    :param finished: whether the page is the last one
+    :return: bytes
+    """
+    rows = b''.join(
+        (
+            f'<Row><Column0>0</Column0><Column1>{iz}{row:08d}{"" if row % 10 == 0 else "X"}</Column1>'
+            f'<Column2>{"" if row % 3 == 0 else f"R{row % 100:02d}M01S01T01"}</Column2>'
+            f'<Column3>Load test title {row}</Column3></Row>'
+        ).encode()
+        for row in range(start, start + count)
+    )
+    resumption = f'<ResumptionToken>{token}</ResumptionToken>'.encode() if token else b''
+
+    return RESULT % (resumption, b'true' if finished else b'false', SCHEMA if start == 0 else b'', rows)
+
+
+class FakeAlmaHandler(BaseHTTPRequestHandler):
+    """
+    Serve Analytics reports and accept webhook emails
+    """
+    server: 'FakeAlmaServer'  # type:ignore[assignment]
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """
+        Return the next page of the Analytics report of the IZ in the path or token, or the number of emails received
+
+        :return: None
+        """
+        if self.path == '/stats':  # Report the emails received
+            self.reply(200, str(self.server.emails).encode())
+            return
+
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)  # Parse the query string
+        token = query.get('token', [None])[0]  # Only later pages are asked for by token
+
+        if token is None:  # Start the report
+            time.sleep(self.server.latency)  # Simulate Alma's time to run the report
+            iz = query.get('path', ['/unknown/'])[0].split('/')[2]  # Get the IZ from e.g. /shared/iz1/report
+            limit = min(int(query.get('limit', [DEFAULT_LIMIT])[0]), MAX_LIMIT)  # Get the rows per page
+            start = 0
+        else:  # Continue the report
+            time.sleep(self.server.page_latency)  # Simulate Alma's time to return the next page
+
+            with self.server.lock:
+                iz, limit, start = self.server.reports.get(token, ('', 0, 0))
+
+            if not iz:  # Check for an unknown or finished token
+                self.reply(400, b'<web_service_result><errorList><error>Invalid token</error></errorList>')
+                return
+
+        count = min(limit, self.server.rows - start)  # Rows in this page
+        finished = start + count >= self.server.rows  # Check for the last page
+
+        with self.server.lock:  # Record where the next page starts
+            if finished:
+                self.server.reports.pop(token or '', None)
+            elif token is None:
+                token = uuid.uuid4().hex
+                self.server.reports[token] = (iz, limit, count)
+            else:
+                self.server.reports[token] = (iz, limit, start + count)
+
+        self.reply(200, build_report(iz, count, start, token if start == 0 else None, finished))
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        """
+        Accept a webhook email
+
+        :return: None
+        """
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))  # Read the email
+        time.sleep(self.server.webhook_latency)  # Simulate the webhook's response time
+
+        with self.server.lock:
+            self.server.emails += 1
+
+        self.reply(201, b'')
+
+    def reply(self, status: int, body: bytes) -> None:
+        """
+        Send a response
+
+        :param status: HTTP status code
+        :param body: response body
+        :return: None
+        """
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+        """
+        Keep the request log quiet
+
+        :return: None
+        """
+
+
+class FakeAlmaServer(ThreadingHTTPServer):
+    """
+    Fake Alma server
+    """
+    daemon_threads = True
+
+    def __init__(self, rows: int, latency: float, page_latency: float, webhook_latency: float) -> None:
+        """
+        Fake Alma server on a free local port
+
+        :param rows: rows in every report
+        :param latency: seconds before the first page of a report is returned
+        :param page_latency: seconds before each later page is returned
+        :param webhook_latency: seconds before an email is accepted
+        :return: None
+        """
+        super().__init__(('127.0.0.1', 0), FakeAlmaHandler)
+        self.rows = rows
+        self.latency = latency
+        self.page_latency = page_latency
+        self.webhook_latency = webhook_latency
+        self.emails = 0  # Emails received
+        self.reports: dict[str, tuple[str, int, int]] = {}  # ResumptionToken to (IZ, rows per page, next row)
+        self.lock = threading.Lock()  # Handler threads share the count and the reports
+
+
+def serve(ports, rows: int, latency: float, page_latency: float, webhook_latency: float) -> None:
+    """
+    Run the fake server until the process is terminated
+
+    :param ports: multiprocessing.Queue to send the server's port to
+    :param rows: rows in every report
+    :param latency: seconds before the first page of a report is returned
+    :param page_latency: seconds before each later page is returned
+    :param webhook_latency: seconds before an email is accepted
+    :return: None
+    """
+    server = FakeAlmaServer(rows, latency, page_latency, webhook_latency)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def seed(session, code: str, izs: int, url: str) -> None:
+    """
+    Add the trigger, the IZs and their analyses, keys and recipients
+
+    :param session: Session object
+    :param code: trigger code
+    :param izs: number of IZs
+    :param url: fake server URL
+    :return: None
+    """
+    # pylint: disable=import-outside-toplevel
+    from models import Analysis, Apikey, Area, Azuretrigger, Config, Iz, Recipient, User
+
+    session.add(Area(id=1, name='analytics'))
+    session.add_all(  # Add the settings the pipeline reads
+        Config(configkey=key, value=value)
+        for key, value in {
+            'alma_region': 'na',
+            'webhook_url': url + '/webhook',
+            'webhook_user': 'loadtest',
+            'webhook_pass': 'loadtest',
+            'sender_email': 'loadtest@example.org'
+        }.items()
+    )
+    session.add(Azuretrigger(id=1, code=code, name=code.replace('_', ' ').title()))
+
+    for i in range(1, izs + 1):  # Add each IZ with its key, user and analysis
+        session.add(Iz(id=i, name=f'IZ {i}', code=f'iz{i}'))
+        session.add(Apikey(apikey=f'key{i}', writekey=False, area_id=1, iz_id=i))
+        session.add(User(id=i, email=f'user{i}@example.org', iz_id=i))
+        session.add(Analysis(id=i, path=f'/shared/iz{i}/report', azuretrigger_id=1, iz_id=i))
+        session.add(Recipient(user_id=i, analysis_id=i))
+
+    session.commit()
+
+
+def expected_emails(code: str, izs: int, rows: int) -> int | None:
+    """
+    Count the emails the trigger should send, by running its transform on a short report of each IZ
+
+    Reports of PATTERN_ROWS rows have the same findings as longer ones, so they give the same reports to send.
+
+    :param code: trigger code
+    :param izs: number of IZs
+    :param rows: rows in every report
+    :return: number of emails, or None if the trigger combines its reports
+    """
+    # pylint: disable=import-outside-toplevel
+    from controllers import parse_report
+    from models import Analysis, session_scope
+    from pipeline import get_pipeline
+
+    pipeline = get_pipeline(code)  # Get the trigger's pipeline
+
+    if pipeline.combine:  # Combined reports depend on every IZ's full report
+        return None
+
+    expected = 0  # Count the emails
+
+    with session_scope(readonly=True) as session:
+        for i in range(1, izs + 1):  # Transform each IZ's report
+            analysis: Analysis = session.get(Analysis, i)  # type:ignore[assignment]
+            body = build_report(f'iz{i}', min(rows, PATTERN_ROWS))  # Serve the report as one page
+            report = parse_report([(io.BytesIO(body), len(body))], analysis, pipeline.columns)
+
+            if report is not None and report.data['data']['rows']:  # Reports without rows send nothing
+                expected += len(pipeline.transform(report, analysis)) * len(analysis.recipients)
+
+    return expected
+
+
+def peak_rss() -> int:
+    """
+    Get the peak resident set size of the process in MB
+
+    :return: int
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """
+    Parse the command line arguments
+
+    :param argv: list of arguments
+    :return: Namespace
+    """
+    parser = argparse.ArgumentParser(description='Load test a trigger against a fake Alma server')
+    parser.add_argument('--code', default='scf_no_x', help='trigger code to run')
+    parser.add_argument('--izs', type=int, default=200, help='number of IZs')
+    parser.add_argument('--rows', type=int, default=20_000, help='rows in every report')
+    parser.add_argument('--latency', type=float, default=1.0, help='seconds Alma takes to return a first page')
+    parser.add_argument('--page-latency', type=float, default=0.1, help='seconds Alma takes to return a later page')
+    parser.add_argument('--webhook-latency', type=float, default=0.1, help='seconds the webhook takes per email')
+    parser.add_argument('--max-rss', type=int, default=1024, help='largest allowed peak RSS in MB')
+    parser.add_argument('--min-rows-per-second', type=float, default=0, help='lowest allowed throughput')
+    parser.add_argument('--verbose', action='store_true', help='log the pipeline')
+
+    return parser.parse_args(argv)
+
+
+def run_load(args: argparse.Namespace, url: str) -> dict:  # pylint: disable=too-many-locals
+    """
+    Seed a temporary database and run the trigger and its resumes against the fake server
+
+    :param args: Namespace
+    :param url: fake server URL
+    :return: dict of seconds per invocation, limit in seconds, outcomes of the analyses, slots left and emails expected
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        # The database and the Alma host are read when the modules are imported
+        os.environ['SQLALCHEMY_DB_URL'] = f'sqlite:///{directory}/loadtest.db'
+        os.environ['ALMA_API_URL'] = url
+
+        # pylint: disable=import-outside-toplevel
+        from sqlalchemy import select
+        from deadline import get_function_timeout
+        from ledger import get_pending
+        from models import Base, RunAnalysis, engine, session_scope
+        from pipeline import resume_runs, run_trigger
+
+        Base.metadata.create_all(engine)  # Create the tables
+
+        with session_scope() as session:  # Seed the database
+            seed(session, args.code, args.izs, url)
+
+        invocations = [timed(partial(run_trigger, args.code))]  # Run the trigger as its timer would
+        pending = get_pending_count(get_pending, session_scope)  # Count the slots left
+
+        while pending and len(invocations) <= args.izs:  # Run the resume timer until no work is left
+            invocations.append(timed(resume_runs))
+            pending = get_pending_count(get_pending, session_scope)
+
+        with session_scope(readonly=True) as session:  # Get the outcome of every analysis
+            outcomes = Counter(session.scalars(select(RunAnalysis.outcome)))
+
+        expected = expected_emails(args.code, args.izs, args.rows)  # Count the emails that should have been sent
+        engine.dispose()  # Close the connections before the database is removed
+
+    return {
+        'invocations': invocations,
+        'limit': get_function_timeout(),
+        'outcomes': outcomes,
+        'pending': pending,
+        'expected': expected
+    }
+
+
+def timed(invocation: Callable[[], Any]) -> float:
+    """
+    Run one invocation and time it
+
+    :param invocation: function run by the invocation
+    :return: seconds taken
+    """
+    start = time.perf_counter()  # Start the timer
+    invocation()
+
+    return time.perf_counter() - start
+
+
+def get_pending_count(get_pending: Callable, session_scope: Callable) -> int:
+    """
+    Count the runs with a slot left to resume
+
+    :param get_pending: ledger.get_pending
+    :param session_scope: models.session_scope
+    :return: int
+    """
+    with session_scope(readonly=True) as session:
+        return len(get_pending(session))
+
+
+def check_limits(args: argparse.Namespace, run: dict, emails: int) -> list[str]:
+    """
+    Compare the run with the limits
+
+    :param args: Namespace
+    :param run: dict returned by run_load
+    :param emails: emails the fake webhook received
+    :return: list of missed limits
+    """
+    seconds = sum(run['invocations'])  # Time spent in every invocation
+    throughput = args.izs * args.rows / seconds  # Rows downloaded, parsed and sent per second
+    unfinished = {outcome: count for outcome, count in run['outcomes'].items() if outcome not in ('sent', 'empty')}
+    failures = []  # Create a list of missed limits
+
+    print(f'{args.code}: {args.izs} IZs x {args.rows} rows, {args.latency}s latency')
+    print(f"{len(run['invocations'])} invocations, longest {max(run['invocations']):.1f}s, {seconds:.1f}s in all")
+    print(f"{throughput:.0f} rows/s, peak RSS {peak_rss()} MB, {emails} emails, outcomes {dict(run['outcomes'])}")
+
+    if max(run['invocations']) > run['limit']:
+        failures.append(f"an invocation took {max(run['invocations']):.1f}s, limit {run['limit']:.1f}s")
+    if peak_rss() > args.max_rss:
+        failures.append(f'peak RSS {peak_rss()} MB, limit {args.max_rss} MB')
+    if throughput < args.min_rows_per_second:
+        failures.append(f'{throughput:.0f} rows/s, limit {args.min_rows_per_second:.0f} rows/s')
+    if run['pending']:
+        failures.append(f"{run['pending']} runs left with work to resume")
+    if unfinished:
+        failures.append(f'analyses not finished: {unfinished}')
+    if run['expected'] is not None and emails != run['expected']:  # Check every report was delivered
+        failures.append(f"{emails} emails sent, expected {run['expected']}")
+
+    return failures
+
+
+def main(argv: list[str] | None = None) -> int:
+    """
+    Start the fake server, run the trigger and check the limits
+
+    :param argv: list of arguments
+    :return: exit code
+    """
+    args = parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(levelname)s %(message)s')
+
+    ports: multiprocessing.Queue = multiprocessing.Queue()  # Start the fake server
+    server = multiprocessing.Process(
+        target=serve, args=(ports, args.rows, args.latency, args.page_latency, args.webhook_latency), daemon=True
+    )
+    server.start()
+    url = f'http://127.0.0.1:{ports.get(timeout=10)}'
+
+    try:
+        run = run_load(args, url)  # Run the trigger
+        emails = int(requests.get(url + '/stats', timeout=10).text)  # Count the emails received
+    finally:
+        server.terminate()  # Stop the fake server
+
+    failures = check_limits(args, run, emails)
+
+    for failure in failures:  # Print the missed limits
+        print(f'FAILED: {failure}', file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,108 @@
 """
 Models for application
 """
+import logging
 import os
-from typing import Any
+from contextlib import contextmanager
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Iterator
 import dotenv
-from sqlalchemy import ForeignKey, String, create_engine
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker
+from sqlalchemy import DateTime, Float, ForeignKey, Integer, String, Text, create_engine, event, exc, make_url, text
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, scoped_session, sessionmaker
+
+if TYPE_CHECKING:  # Only for annotations, so the settings it reads are loaded from .env first
+    from spill import BodyFile
 
 dotenv.load_dotenv()
 
-engine = create_engine(os.getenv("SQLALCHEMY_DB_URL"))  # type:ignore[arg-type] # Create a new SQLite database
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))  # Connections kept open, enough for every pipeline worker
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '5'))  # Extra connections opened when the pool is empty
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '280'))  # Seconds before a connection is replaced
+DB_PRE_PING = os.getenv('DB_PRE_PING', 'true').lower() == 'true'  # Test connections before using them
+DB_WARM_CONNECTIONS = int(os.getenv('DB_WARM_CONNECTIONS', '2'))  # Connections opened on cold start
+
+
+def get_engine_options(url: str | None) -> dict[str, Any]:
+    """
+    Get the engine's pool options for the database URL
+
+    Connections are recycled before MySQL's or the Azure gateway's idle timeout closes them, and pre-ping replaces
+    those closed anyway, so a warm function instance does not stall on a dead connection.
+
+    :param url: database URL
+    :return: dict of create_engine keyword arguments
+    """
+    options: dict[str, Any] = {'pool_pre_ping': DB_PRE_PING, 'pool_recycle': DB_POOL_RECYCLE}
+
+    if url and make_url(url).get_backend_name() != 'sqlite':  # SQLite pools are not sized
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+
+    return options
+
+
+DB_URL = os.getenv("SQLALCHEMY_DB_URL")  # Database URL
+
+engine = create_engine(DB_URL, **get_engine_options(DB_URL))  # type:ignore[arg-type] # Create the engine
 session_factory = sessionmaker(bind=engine)  # Create a session factory
+readonly_factory = sessionmaker(  # Sessions for queries only, outside a transaction
+    bind=engine.execution_options(isolation_level='AUTOCOMMIT'),
+    autoflush=False
+)
+
+
+@event.listens_for(readonly_factory, 'before_flush')
+def block_flush(session, flush_context, instances) -> None:  # pylint: disable=unused-argument
+    """
+    Stop a read-only session from writing
+
+    :param session: Session object
+    :param flush_context: UOWTransaction
+    :param instances: deprecated, always None
+    :return: None
+    """
+    raise exc.InvalidRequestError('Read-only session cannot write to the database')
+
+
+@contextmanager
+def session_scope(readonly: bool = False) -> Iterator[scoped_session]:
+    """
+    Create a session that is removed when the block exits, however it exits
+
+    Uncommitted changes are rolled back when the session is removed, so writers commit explicitly.
+
+    :param readonly: use a read-only session for metadata queries
+    :return: iterator of Session object
+    """
+    session = scoped_session(readonly_factory if readonly else session_factory)  # Create a session
+
+    try:
+        yield session
+    finally:
+        session.remove()  # Remove the session
+
+
+def warm_up(connections: int = DB_WARM_CONNECTIONS) -> None:
+    """
+    Open connections on cold start so the first invocation does not wait for them
+
+    :param connections: connections to open
+    :return: None
+    """
+    opened = []  # Create a list of open connections
+
+    try:
+        for _ in range(connections):  # Open the connections
+            connection = engine.connect()
+            opened.append(connection)
+            connection.execute(text('SELECT 1'))
+    except exc.SQLAlchemyError as e:  # Handle exceptions
+        logging.error('Error: %s', e)  # log the error
+    finally:
+        for connection in opened:  # Return the connections to the pool
+            connection.close()
+
+    logging.debug('Database connections warmed: %s', len(opened))  # Log the success message
 
 
 class Base(DeclarativeBase):  # pylint: disable=too-few-public-methods
@@ -90,11 +182,16 @@ class Azuretrigger(Base):  # pylint: disable=too-few-public-methods
     id: Mapped[int] = mapped_column(primary_key=True)  # Trigger ID
     code: Mapped[str] = mapped_column(String(50))  # Trigger code
     name: Mapped[str] = mapped_column(String(255))  # Trigger name
+    schedule: Mapped[str | None] = mapped_column(String(50), nullable=True)  # NCRONTAB timer schedule
 
     analyses: Mapped[list["Analysis"]] = relationship(  # type:ignore[name-defined]  # noqa: F821
         back_populates="azuretrigger",
         cascade="all, delete-orphan",
     )
+    runs: Mapped[list["Run"]] = relationship(  # type:ignore[name-defined]  # noqa: F821
+        back_populates="azuretrigger",
+        cascade="all, delete-orphan",
+    )
 
     def __repr__(self) -> str:
         return f"Trigger(id={self.id!r}, name={self.name!r})"
@@ -160,6 +257,54 @@ class Recipient(Base):  # pylint: disable=too-few-public-methods
         return f"Recipient(id={self.id!r})"
 
 
+class Run(Base):  # pylint: disable=too-few-public-methods
+    """
+    Run model
+    """
+    __tablename__ = "run"
+
+    id: Mapped[int] = mapped_column(primary_key=True)  # Run ID
+    azuretrigger_id: Mapped[int] = mapped_column(ForeignKey("azuretrigger.id"))  # Trigger ID
+    started: Mapped[datetime] = mapped_column(DateTime)  # Time the run started
+    finished: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)  # Time the last slot finished
+    slots: Mapped[int] = mapped_column(Integer, default=1)  # Number of slots the analyses were split into
+    outcome: Mapped[str] = mapped_column(String(20))  # running, partial or complete
+
+    azuretrigger: Mapped["Azuretrigger"] = relationship(  # type:ignore[name-defined]  # noqa: F821
+        back_populates="runs"
+    )
+    run_analyses: Mapped[list["RunAnalysis"]] = relationship(  # type:ignore[name-defined]  # noqa: F821
+        back_populates="run",
+        cascade="all, delete-orphan",
+    )
+
+    def __repr__(self) -> str:
+        return f"Run(id={self.id!r}, outcome={self.outcome!r})"
+
+
+class RunAnalysis(Base):  # pylint: disable=too-few-public-methods
+    """
+    Run analysis model
+    """
+    __tablename__ = "run_analysis"
+
+    id: Mapped[int] = mapped_column(primary_key=True)  # Run analysis ID
+    run_id: Mapped[int] = mapped_column(ForeignKey("run.id"))  # Run ID
+    analysis_id: Mapped[int] = mapped_column(ForeignKey("analysis.id"))  # Analysis ID
+    slot: Mapped[int] = mapped_column(Integer, default=0)  # Slot the analysis is planned in
+    started: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)  # Time the slot was claimed or started
+    duration: Mapped[float | None] = mapped_column(Float, nullable=True)  # Seconds from download to last delivery
+    rows: Mapped[int | None] = mapped_column(Integer, nullable=True)  # Rows in the report
+    bytes: Mapped[int | None] = mapped_column(Integer, nullable=True)  # Size of the Analytics response
+    outcome: Mapped[str] = mapped_column(String(20))  # pending, running, sent, empty, failed or deferred
+    deliveries: Mapped[str | None] = mapped_column(Text, nullable=True)  # Deferred [recipient, subject] pairs as JSON
+
+    run: Mapped["Run"] = relationship(back_populates="run_analyses")  # type:ignore[name-defined]  # noqa: F821
+
+    def __repr__(self) -> str:
+        return f"RunAnalysis(id={self.id!r}, outcome={self.outcome!r})"
+
+
 class User(Base):  # pylint: disable=too-few-public-methods
     """
     User model
@@ -181,20 +326,48 @@ class User(Base):  # pylint: disable=too-few-public-methods
         return f"User(id={self.id!r}, username={self.email!r})"
 
 
+class Attachment:  # pylint: disable=too-few-public-methods
+    """
+    Attachment object
+    """
+    def __init__(self, name: str, content: bytes, content_type: str) -> None:
+        """
+        Attachment object
+
+        :param name: str
+        :param content: bytes
+        :param content_type: str
+        :return: None
+        """
+        self.name = name
+        self.content = content
+        self.content_type = content_type
+
+    def __str__(self) -> str:
+        """
+        Return the attachment as a string
+
+        :return: str
+        """
+        return f"{self.name} ({self.content_type}, {len(self.content)} bytes)"
+
+
 class Email:  # pylint: disable=too-few-public-methods
     """
     Email object
     """
-    def __init__(self, subject: str, body: str) -> None:
+    def __init__(self, subject: str, body: 'str | BodyFile', attachments: list[Attachment] | None = None) -> None:
         """
         Email object
 
         :param subject: str
-        :param body: str
+        :param body: str, or BodyFile for the body of a report spilled to disk
+        :param attachments: list of Attachment or None
         :return: None
         """
         self.subject = subject
         self.body = body
+        self.attachments = attachments or []
 
     def __str__(self) -> str:
         """
@@ -218,6 +391,17 @@ class Report:  # pylint: disable=too-few-public-methods
         """
         self.data = data
 
+    def close(self) -> None:
+        """
+        Release the report's rows, removing the row file of a report spilled to disk
+
+        :return: None
+        """
+        rows: Any = (self.data.get('data') or {}).get('rows')  # Get the report's rows
+
+        if hasattr(rows, 'close'):  # Only a RowFile holds a file
+            rows.close()
+
     def __str__(self) -> str:
         """
         Return the report as a string
@@ -0,0 +1,532 @@
+"""
+Trigger registry and the shared pipeline that runs a trigger's analyses.
+"""
+import logging
+import os
+import time
+import queue
+import threading
+from functools import partial
+from itertools import chain
+from typing import Any, Callable, Iterable
+import requests  # type:ignore[import-untyped]
+import sqlalchemy
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session
+from controllers import (
+    BARCODE_HEADING, WEBHOOK_TIMEOUT, check_exception, construct_email, get_analysis, get_trigger_analyses,
+    parse_report, prefetch_secrets, send_email
+)
+from deadline import DELIVERY_RESERVE, Deadline
+from duplicates import find_duplicates, get_barcodes, get_duplicates_report
+from ledger import Ledger, get_pending, resume_run, start_run
+from models import Analysis, Azuretrigger, Email, Report, session_factory, session_scope
+from validation import RULES, get_rule_reports
+
+WORKERS = int(os.getenv('PIPELINE_WORKERS', '4'))  # Analytics downloads at the same time
+# Reports parsed at the same time. Building the rows holds the GIL, so more threads do not parse faster; one worker
+# parses a 20,000-row report in about 0.6s, or 200 such reports in about 2 minutes, well inside one invocation.
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', '1'))
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', '1'))  # Emails rendered at the same time
+DELIVER_WORKERS = int(os.getenv('DELIVER_WORKERS', '4'))  # Emails posted to the webhook at the same time
+QUEUE_SIZE = int(os.getenv('QUEUE_SIZE', '4'))  # Items waiting between two stages before the first one blocks
+
+Transform = Callable[[Report, Analysis], list[Report]]  # Turn one analysis's report into the reports to send
+Combine = Callable[[list[tuple[Analysis, Report]]], list[tuple[Analysis, Report]]]  # Turn all reports at once
+
+
+def single(report: Report, analysis: Analysis) -> list[Report]:  # pylint: disable=unused-argument
+    """
+    Send the report unchanged
+
+    :param report: Report
+    :param analysis: Analysis
+    :return: list of Report
+    """
+    return [report]
+
+
+def combine_duplicates(results: list[tuple[Analysis, Report]]) -> list[tuple[Analysis, Report]]:
+    """
+    Replace every IZ's report with the duplicates found within and across all the IZs' reports
+
+    :param results: list of (Analysis, Report)
+    :return: list of (Analysis, Report)
+    """
+    duplicates = find_duplicates(  # Find duplicates within and across IZs in one pass
+        chain.from_iterable(get_barcodes(report, analysis.iz.code) for analysis, report in results)
+    )
+
+    combined: list[tuple[Analysis, Report]] = []  # Create a list of reports to send
+
+    for analysis, _ in results:  # Iterate through the analyses
+        report = get_duplicates_report(duplicates, analysis)  # Get the IZ's duplicates
+
+        if not check_exception(report):  # Check for empty or errors
+            logging.info('No duplicates for %s %s', analysis.iz.code, analysis.azuretrigger.name)
+            continue
+
+        combined.append((analysis, report))  # type:ignore[arg-type]  # Add the report to the list
+
+    return combined
+
+
+class Pipeline:  # pylint: disable=too-few-public-methods
+    """
+    Pipeline object
+    """
+    def __init__(
+            self,
+            code: str,
+            schedule: str | None = None,
+            transform: Transform = single,
+            combine: Combine | None = None,
+            columns: list[str] | None = None
+    ) -> None:
+        """
+        Pipeline object
+
+        :param code: trigger code
+        :param schedule: default NCRONTAB schedule, overridden by the trigger's schedule in the database
+        :param transform: stage run on each analysis's report
+        :param combine: stage run on every analysis's report at once, after transform
+        :param columns: headings of the columns the stages need, the only ones whose values are stored; defaults to
+            every column that is not hidden
+        :return: None
+        """
+        self.code = code
+        self.schedule = schedule
+        self.transform = transform
+        self.combine = combine
+        self.columns = columns
+
+    def __str__(self) -> str:
+        """
+        Return the pipeline as a string
+
+        :return: str
+        """
+        return f"{self.code} ({self.schedule})"
+
+
+PIPELINES: dict[str, Pipeline] = {}  # Registered pipelines by trigger code
+
+
+def register(pipeline: Pipeline) -> Pipeline:
+    """
+    Register a pipeline for a trigger code
+
+    :param pipeline: Pipeline
+    :return: Pipeline
+    """
+    PIPELINES[pipeline.code] = pipeline  # Add the pipeline to the registry
+
+    return pipeline
+
+
+register(Pipeline('scf_withdrawn', '0 0 11 1 7 *'))  # 11:00 on the first day of July
+register(Pipeline('item_checks', '0 30 11 1 * *', transform=get_rule_reports))  # 11:30 on the first of the month
+register(Pipeline(  # 12:00 on the first of the month; analyses must be full barcode extracts (see duplicates.py)
+    'scf_duplicate', '0 0 12 1 * *', combine=combine_duplicates, columns=[BARCODE_HEADING]
+))
+register(Pipeline('scf_no_x', '0 30 12 1 * *'))  # 12:30 on the first day of every month
+register(Pipeline('scf_no_row_tray', '0 0 13 1 1,7 *'))  # 13:00 on the first day of January and July
+register(Pipeline('scf_incorrect_row_tray', '0 30 13 1 1,7 *'))  # 13:30 on the first day of January and July
+register(Pipeline('iz_no_row_tray', '0 0 14 1 * *'))  # 14:00 on the first day of every month
+register(Pipeline('iz_incorrect_row_tray', '0 30 14 1 * *'))  # 14:30 on the first day of every month
+
+
+def get_pipeline(code: str) -> Pipeline:
+    """
+    Get the registered pipeline for a trigger code, or the default pipeline
+
+    :param code: trigger code
+    :return: Pipeline
+    """
+    return PIPELINES.get(code) or Pipeline(code)
+
+
+def get_schedules() -> dict[str, str]:
+    """
+    Get the schedule of every trigger
+
+    Triggers in the database with a schedule are added to, or override, the registered pipelines. Once item_checks is
+    in the database, the triggers its rules replace are not scheduled, so their findings are not sent twice. If the
+    database cannot be reached the registered schedules are used.
+
+    :return: dict of trigger code to NCRONTAB schedule
+    """
+    schedules = {code: pipeline.schedule for code, pipeline in PIPELINES.items() if pipeline.schedule}
+
+    with session_scope(readonly=True) as session:  # Create a session
+        try:
+            triggers = session.execute(select(Azuretrigger.code, Azuretrigger.schedule)).all()
+        except sqlalchemy.exc.SQLAlchemyError as e:  # Handle exceptions
+            logging.error('Error: %s', e)  # log the error
+            triggers = []
+
+    for code, schedule in triggers:  # Iterate through the triggers
+        if schedule:  # Add the trigger's schedule
+            schedules[code] = schedule
+
+    if 'item_checks' in {code for code, _ in triggers}:  # Retire the triggers replaced by the item checks
+        for rule in RULES:
+            schedules.pop(rule.code, None)
+
+    return schedules
+
+
+class Stage:  # pylint: disable=too-few-public-methods
+    """
+    Stage object
+    """
+    def __init__(self, name: str, function: Callable[[Any], Iterable[Any]], workers: int) -> None:
+        """
+        Stage object
+
+        :param name: stage name used in the logs
+        :param function: function turning one input into any number of outputs for the next stage
+        :param workers: threads running the stage
+        :return: None
+        """
+        self.name = name
+        self.function = function
+        self.workers = max(workers, 1)
+
+    def __str__(self) -> str:
+        """
+        Return the stage as a string
+
+        :return: str
+        """
+        return f"{self.name} ({self.workers} workers)"
+
+
+STOP = object()  # Tells a stage worker there is no more input
+
+
+def run_stages(items: Iterable[Any], stages: list[Stage], session: scoped_session) -> list[Any]:
+    """
+    Run the items through the stages with bounded queues between them
+
+    Every stage runs on its own threads, so downloads, parsing, rendering and delivery overlap. A stage blocks when the
+    queue to the next stage is full, which keeps a fast stage from running ahead of a slow one.
+
+    :param items: inputs of the first stage
+    :param stages: list of Stage
+    :param session: Session object, removed on each worker thread when it finishes
+    :return: list of outputs of the last stage
+    """
+    queues: list[queue.Queue] = [queue.Queue(maxsize=QUEUE_SIZE) for _ in stages]  # Create the input queues
+    results: list[Any] = []  # Create a list of outputs of the last stage
+
+    def work(index: int) -> None:
+        stage = stages[index]  # Get the worker's stage
+        output = queues[index + 1].put if index + 1 < len(stages) else results.append  # Get the worker's output
+
+        try:
+            while (item := queues[index].get()) is not STOP:  # Take inputs until the stage is stopped
+                try:
+                    for result in stage.function(item):  # Run the stage
+                        output(result)  # Pass the output on, waiting for space in the next queue
+                except Exception as e:  # pylint: disable=broad-exception-caught  # Keep the worker running
+                    logging.error('Stage %s failed: %s', stage.name, e)
+        finally:
+            session.remove()  # Remove the worker's session
+
+    threads = [  # Start the workers of every stage
+        [threading.Thread(target=work, args=(index,), name=f'{stage.name}-{i}') for i in range(stage.workers)]
+        for index, stage in enumerate(stages)
+    ]
+
+    for thread in chain.from_iterable(threads):
+        thread.start()
+
+    for item in items:  # Feed the first stage
+        queues[0].put(item)
+
+    for index, stage in enumerate(stages):  # Stop each stage once the stage before it has finished
+        for _ in range(stage.workers):
+            queues[index].put(STOP)
+
+        for thread in threads[index]:
+            thread.join()
+
+    return results
+
+
+def release(reports: list[Report], kept: list[Report]) -> None:
+    """
+    Release the rows of the reports that have been replaced
+
+    :param reports: list of Report read by a transform or combine stage
+    :param kept: list of Report the stage passes on, released once their emails are rendered
+    :return: None
+    """
+    for report in reports:  # Iterate through the reports
+        if all(report is not other for other in kept):  # Check the report was replaced
+            report.close()
+
+
+def combine_reports(function: Combine, results: list[tuple[Analysis, Report]]) -> list[tuple[Analysis, Report]]:
+    """
+    Combine stage: turn every analysis's report into the reports to send, releasing the rows that were replaced
+
+    :param function: the pipeline's Combine
+    :param results: list of (Analysis, Report)
+    :return: list of (Analysis, Report)
+    """
+    combined = function(results)  # Combine the reports
+    release([report for _, report in results], [report for _, report in combined])  # Release the replaced rows
+
+    return combined
+
+
+def download(
+        session: scoped_session,
+        deadline: Deadline,
+        ledger: Ledger,
+        analysis: Analysis
+) -> Iterable[tuple[Analysis, Any]]:
+    """
+    Download stage: get every page of the report from Alma Analytics
+
+    :param session: Session object
+    :param deadline: Deadline
+    :param ledger: Ledger
+    :param analysis: Analysis
+    :return: iterable of (Analysis, list of pages)
+    """
+    ledger.record(analysis.id)  # Start timing the analysis
+
+    pages = get_analysis(analysis, session, deadline)  # Get the data from Alma Analytics
+
+    if check_exception(pages):  # Check for empty or errors
+        yield analysis, pages
+
+
+def parse(pipeline: Pipeline, ledger: Ledger, item: tuple[Analysis, Any]) -> Iterable[tuple[Analysis, Report]]:
+    """
+    Parse stage: parse and transform the report
+
+    :param pipeline: Pipeline
+    :param ledger: Ledger
+    :param item: (Analysis, list of pages)
+    :return: iterable of (Analysis, Report)
+    """
+    analysis, pages = item
+    start = time.perf_counter()  # Start the timer
+
+    report = parse_report(pages, analysis, pipeline.columns)  # Parse the report's projected columns
+
+    if not check_exception(report):  # Check for errors
+        logging.error('Report failed to parse: %s %s', analysis.iz.code, analysis.azuretrigger.name)
+        ledger.record(analysis.id, outcome='failed')
+        return
+
+    data = report.data['data']  # type:ignore[union-attr]
+    ledger.record(analysis.id, rows=len(data['rows']), bytes=data.get('bytes'), outcome='empty')  # Nothing sent yet
+
+    if not data['rows']:  # Check for a report without rows
+        logging.info('No results for report %s %s', analysis.iz.code, analysis.azuretrigger.name)
+        report.close()  # type:ignore[union-attr]  # Nothing to send
+        return
+
+    logging.info(  # Log the analysis metrics
+        'Analysis %s %s: %s rows parsed in %.2fs',
+        analysis.iz.code,
+        analysis.azuretrigger.name,
+        len(data['rows']),
+        time.perf_counter() - start
+    )
+
+    transformed = pipeline.transform(report, analysis)  # type:ignore[arg-type]  # Transform the report
+    release([report], transformed)  # type:ignore[list-item]  # Release the rows the transform has replaced
+
+    for result in transformed:  # Pass each report on
+        yield analysis, result
+
+
+def render(
+        deliveries: dict[int, set[tuple[str, str]] | None] | None,
+        item: tuple[Analysis, Report]
+) -> Iterable[tuple[Analysis, Email, str]]:
+    """
+    Render stage: construct the email once for all the analysis's recipients
+
+    The email holds everything that is sent, so the report's rows are released once it has been constructed. A
+    resumed run only sends the emails its claimed analyses have not sent yet.
+
+    :param deliveries: dict of claimed Analysis ID to the [recipient, subject] pairs still to send (None for every
+        recipient), or None for a new run
+    :param item: (Analysis, Report)
+    :return: iterable of (Analysis, Email, recipient address)
+    """
+    analysis, report = item
+
+    try:
+        email = construct_email(report)  # Construct the email
+    finally:
+        report.close()  # Release the report's rows
+
+    if not check_exception(email) or (deliveries is not None and analysis.id not in deliveries):  # Check for no email
+        return
+
+    waiting = deliveries.get(analysis.id) if deliveries else None  # Get the recipients still waiting, if recorded
+
+    for recipient in analysis.recipients:  # Iterate through the analysis's recipients
+        if not check_exception(recipient):  # Check for empty or errors
+            continue
+
+        if waiting is None or (recipient.user.email, email.subject) in waiting:  # type:ignore[union-attr]
+            yield analysis, email, recipient.user.email  # type:ignore[misc]
+
+
+def deliver(
+        session: scoped_session,
+        deadline: Deadline,
+        ledger: Ledger,
+        item: tuple[Analysis, Email, str]
+) -> Iterable[None]:
+    """
+    Deliver stage: send the email to one recipient
+
+    :param session: Session object
+    :param deadline: Deadline
+    :param ledger: Ledger
+    :param item: (Analysis, Email, recipient address)
+    :return: empty iterable
+    """
+    analysis, email, to = item
+
+    if deadline.timeout(WEBHOOK_TIMEOUT) is None:  # Check for too little time left
+        deadline.defer('deliver', analysis.id, to)
+        ledger.defer(analysis.id, to, email.subject)
+        return []
+
+    try:
+        if not send_email(email, to, session, deadline):  # Send email to recipient, unless the time has run out
+            deadline.defer('deliver', analysis.id, to)
+            ledger.defer(analysis.id, to, email.subject)
+            return []
+
+        ledger.record(analysis.id, outcome='sent')
+    except requests.exceptions.RequestException as e:  # Handle exceptions
+        logging.error('Delivery failed for %s %s: %s', analysis.iz.code, analysis.azuretrigger.name, e)
+        ledger.record(analysis.id, outcome='failed')
+
+    return []
+
+
+def run_trigger(  # pylint: disable=too-many-locals
+        code: str,
+        workers: int | None = None,
+        deadline: Deadline | None = None,
+        analysis_ids: list[int] | None = None,
+        run_id: int | None = None
+) -> Deadline:
+    """
+    Run a trigger: download, parse and transform each analysis, then render and deliver the reports
+
+    A new run is recorded in the ledger and planned into slots from the analyses' past durations; only the first
+    slot runs now and the resume timer runs the rest.
+
+    :param code: trigger code
+    :param workers: Analytics downloads at the same time, defaults to PIPELINE_WORKERS
+    :param deadline: Deadline, defaults to the functionTimeout from now
+    :param analysis_ids: only run these analyses, or with run_id the analyses of the slot to claim
+    :param run_id: Run ID of the ledger run being resumed
+    :return: Deadline with the work that was deferred
+    """
+    deadline = deadline or Deadline()  # Start the invocation's deadline
+    pipeline = get_pipeline(code)  # Get the trigger's pipeline
+    ledger = Ledger()  # Create the run's ledger
+    start = time.perf_counter()  # Start the timer
+
+    with (
+        session_scope(readonly=True) as session,  # Create a session for the trigger's metadata
+        session_factory(expire_on_commit=False) as ledger_session  # Separate session so commits keep analyses loaded
+    ):
+        analyses = get_trigger_analyses(code, session)  # Get the trigger's analyses
+
+        if not check_exception(analyses):  # Check for empty or errors
+            return deadline
+
+        analyses = [analysis for analysis in analyses if check_exception(analysis)]  # type:ignore[union-attr]
+
+        if run_id is None:  # Record a new run and plan its slots
+            run, analyses = start_run(
+                analyses[0].azuretrigger_id,
+                [analysis for analysis in analyses if analysis_ids is None or analysis.id in analysis_ids],
+                workers or WORKERS,
+                pipeline.combine is None,  # Combined reports need every analysis in one slot
+                ledger_session
+            ) if analyses else (None, [])
+            deliveries = None  # Send every email
+        else:  # Claim the next slot of a recorded run
+            run, analyses, deliveries = resume_run(
+                run_id, analyses, analysis_ids or [], pipeline.combine is None, ledger_session
+            )
+
+        if run is None or not analyses:  # Check for nothing to run
+            return deadline
+
+        fetch_stages = [  # Stages run on each analysis
+            Stage('download', partial(download, session, deadline, ledger), workers or WORKERS),
+            Stage('parse', partial(parse, pipeline, ledger), PARSE_WORKERS),
+        ]
+        send_stages = [  # Stages run on each report
+            Stage('render', partial(render, deliveries), RENDER_WORKERS),
+            Stage('deliver', partial(deliver, session, deadline, ledger), DELIVER_WORKERS),
+        ]
+
+        prefetch_secrets(analyses, session)  # Take credential lookups off the hot path
+
+        if pipeline.combine:  # Wait for every report before combining them
+            results = combine_reports(pipeline.combine, run_stages(analyses, fetch_stages, session))
+            run_stages(results, send_stages, session)
+        else:  # Stream each report straight through to delivery
+            run_stages(analyses, fetch_stages + send_stages, session)
+
+        ledger.save(  # Record the metrics of the claimed analyses
+            run,
+            deliveries if deliveries is not None else [analysis.id for analysis in analyses],
+            deadline,
+            ledger_session
+        )
+
+    logging.info('Trigger %s finished in %.2fs', code, time.perf_counter() - start)  # Log the trigger metrics
+
+    if deadline.deferred:  # Log the work to resume
+        logging.warning(
+            'Trigger %s deferred %s items; resume analyses %s',
+            code,
+            len(deadline.deferred),
+            sorted({analysis for _, analysis, _ in deadline.deferred if analysis is not None})
+        )
+
+    return deadline
+
+
+def resume_runs() -> Deadline:
+    """
+    Run the next slot of every recent run with work left, sharing one deadline
+
+    :return: Deadline with the work that was deferred
+    """
+    deadline = Deadline()  # Start the invocation's deadline
+    with session_scope(readonly=True) as session:  # Create a session
+        try:
+            pending = [(run.id, run.azuretrigger.code, ids) for run, ids in get_pending(session)]  # Get the work left
+        except sqlalchemy.exc.SQLAlchemyError as e:  # Handle exceptions
+            logging.error('Error: %s', e)  # log the error
+            pending = []
+
+    for run_id, code, analysis_ids in pending:  # Run each run's next slot
+        if deadline.timeout(DELIVERY_RESERVE) is None:  # Check for too little time left
+            logging.warning('Run %s left for the next resume: %s', run_id, deadline)
+            continue
+
+        run_trigger(code, deadline=deadline, analysis_ids=analysis_ids, run_id=run_id)
+
+    return deadline
@@ -0,0 +1,286 @@
+"""
+Secret provider with a per-process cache over the database, Azure Key Vault or the environment.
+
+Secrets are named so the same name works in every backend:
+    apikey-<iz id>-<area id>-<write>   API key, e.g. apikey-3-1-0
+    config-<key>                       Config value, e.g. config-webhook-pass
+
+The env backend reads the upper-cased name with dashes as underscores (e.g. CONFIG_WEBHOOK_PASS), or the name
+itself from the JSON file in SECRETS_FILE. The keyvault and env backends fall back to the database for any secret
+they do not hold.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable
+from azure.core.exceptions import AzureError, ResourceNotFoundError
+from azure.identity import DefaultAzureCredential
+from azure.keyvault.secrets import SecretClient
+from sqlalchemy import select
+from sqlalchemy.orm import scoped_session
+from models import Apikey, Config
+
+SECRET_BACKEND = os.getenv('SECRET_BACKEND', 'db')  # Where secrets are read from: db, keyvault or env
+SECRET_TTL = int(os.getenv('SECRET_TTL', '3600'))  # Seconds a secret is cached for
+SECRET_CACHE_SIZE = int(os.getenv('SECRET_CACHE_SIZE', '1024'))  # Secrets cached before the oldest is evicted
+KEY_VAULT_URL = os.getenv('KEY_VAULT_URL')  # e.g. https://<vault name>.vault.azure.net
+SECRETS_FILE = os.getenv('SECRETS_FILE')  # JSON file of secret name to value for the env backend
+
+
+def apikey_name(iz: int, area: int, write: int) -> str:
+    """
+    Get the secret name of an API key
+
+    :param iz: IZ ID
+    :param area: Area ID
+    :param write: 1 for a write key, 0 for a read key
+    :return: str
+    """
+    return f'apikey-{iz}-{area}-{int(write)}'
+
+
+def config_name(key: str) -> str:
+    """
+    Get the secret name of a config value
+
+    :param key: config key
+    :return: str
+    """
+    return 'config-' + key.replace('_', '-')
+
+
+class DbBackend:  # pylint: disable=too-few-public-methods
+    """
+    Read secrets from the Apikey and Config tables
+    """
+    def fetch(self, names: list[str], session: scoped_session) -> dict[str, str]:
+        """
+        Get the secrets with one query per table
+
+        :param names: secret names
+        :param session: Session object
+        :return: dict of secret name to value
+        """
+        configs = {name: name.removeprefix('config-').replace('-', '_') for name in names if name.startswith('config-')}
+        apikeys = [name for name in names if name.startswith('apikey-')]
+        secrets = {}  # Create a dictionary of secrets
+
+        if configs:  # Select the config values
+            stmt = select(Config).where(Config.configkey.in_(configs.values()))
+            found = {config.configkey: config.value for config in session.scalars(stmt)}
+            secrets.update({name: found[key] for name, key in configs.items() if key in found})
+
+        if apikeys:  # Select the API keys of the IZs
+            izs = {int(name.split('-')[1]) for name in apikeys}
+            keys = session.scalars(select(Apikey).where(Apikey.iz_id.in_(izs)))
+            found = {apikey_name(key.iz_id, key.area_id, key.writekey): key.apikey for key in keys}
+            secrets.update({name: found[name] for name in apikeys if name in found})
+
+        return secrets
+
+
+class KeyVaultBackend:  # pylint: disable=too-few-public-methods
+    """
+    Read secrets from Azure Key Vault
+    """
+    def __init__(self, url: str) -> None:
+        """
+        Key Vault backend
+
+        :param url: vault URL
+        :return: None
+        """
+        self.client = SecretClient(vault_url=url, credential=DefaultAzureCredential())
+
+    def fetch(self, names: list[str], session: scoped_session) -> dict[str, str]:  # pylint: disable=unused-argument
+        """
+        Get the secrets from the vault
+
+        :param names: secret names
+        :param session: Session object
+        :return: dict of secret name to value
+        """
+        secrets = {}  # Create a dictionary of secrets
+
+        for name in names:  # Iterate through the secrets
+            try:
+                secrets[name] = self.client.get_secret(name).value
+            except ResourceNotFoundError:  # Skip missing secrets
+                continue
+            except AzureError as e:  # Handle exceptions
+                logging.error('Error: %s', e)
+
+        return secrets  # type:ignore[return-value]
+
+
+class EnvBackend:  # pylint: disable=too-few-public-methods
+    """
+    Read secrets from environment variables or a local JSON file
+    """
+    def __init__(self, path: str | None) -> None:
+        """
+        Env backend
+
+        :param path: JSON file of secret name to value
+        :return: None
+        """
+        self.values: dict[str, str] = {}
+
+        if path:  # Load the local file
+            with open(path, encoding='utf-8') as file:
+                self.values = json.load(file)
+
+    def fetch(self, names: list[str], session: scoped_session) -> dict[str, str]:  # pylint: disable=unused-argument
+        """
+        Get the secrets from the environment, then the local file
+
+        :param names: secret names
+        :param session: Session object
+        :return: dict of secret name to value
+        """
+        secrets = {}  # Create a dictionary of secrets
+
+        for name in names:  # Iterate through the secrets
+            value = os.getenv(name.upper().replace('-', '_'), self.values.get(name))
+
+            if value is not None:
+                secrets[name] = value
+
+        return secrets
+
+
+class ChainBackend:  # pylint: disable=too-few-public-methods
+    """
+    Read secrets from each backend in turn, asking the next one only for those still missing
+    """
+    def __init__(self, backends: list) -> None:
+        """
+        Chain backend
+
+        :param backends: backends in order of preference
+        :return: None
+        """
+        self.backends = backends
+
+    def fetch(self, names: list[str], session: scoped_session) -> dict[str, str]:
+        """
+        Get the secrets from the first backend that has them
+
+        :param names: secret names
+        :param session: Session object
+        :return: dict of secret name to value
+        """
+        secrets: dict[str, str] = {}  # Create a dictionary of secrets
+
+        for backend in self.backends:  # Iterate through the backends
+            missing = [name for name in names if name not in secrets]
+
+            if not missing:  # Check for nothing left to fetch
+                break
+
+            secrets.update(backend.fetch(missing, session))
+
+        return secrets
+
+
+class SecretProvider:
+    """
+    Cache secrets from a backend for a limited time
+    """
+    def __init__(self, backend, ttl: int = SECRET_TTL, size: int = SECRET_CACHE_SIZE) -> None:
+        """
+        Secret provider
+
+        :param backend: object with fetch(names, session)
+        :param ttl: seconds a secret is cached for
+        :param size: secrets cached before the least recently used is evicted
+        :return: None
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.size = size
+        self.cache: OrderedDict[str, tuple[str, float]] = OrderedDict()  # Secret name to (value, expiry)
+        self.lock = threading.Lock()  # Pipeline workers share the cache
+
+    def prefetch(self, names: Iterable[str], session: scoped_session) -> None:
+        """
+        Cache every secret that is missing or expired in one backend call
+
+        :param names: secret names
+        :param session: Session object
+        :return: None
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            missing = [name for name in dict.fromkeys(names) if name not in self.cache or self.cache[name][1] < now]
+
+        if not missing:  # Check for nothing to fetch
+            return
+
+        secrets = self.backend.fetch(missing, session)  # Get the secrets from the backend
+
+        with self.lock:
+            for name, value in secrets.items():  # Cache the secrets
+                self.cache[name] = (value, now + self.ttl)
+                self.cache.move_to_end(name)
+
+            while len(self.cache) > self.size:  # Evict the least recently used secrets
+                self.cache.popitem(last=False)
+
+        logging.debug('Secrets fetched: %s of %s', len(secrets), len(missing))  # Log the success message
+
+    def get(self, name: str, session: scoped_session) -> str | None:
+        """
+        Get a secret, fetching it if it is not cached
+
+        :param name: secret name
+        :param session: Session object
+        :return: str or None
+        """
+        with self.lock:
+            cached = self.cache.get(name)
+
+            if cached and cached[1] >= time.monotonic():  # Return the cached secret
+                self.cache.move_to_end(name)
+                return cached[0]
+
+        self.prefetch([name], session)  # Fetch the secret
+
+        with self.lock:
+            cached = self.cache.get(name)
+
+        return cached[0] if cached else None
+
+    def clear(self) -> None:
+        """
+        Remove every cached secret
+
+        :return: None
+        """
+        with self.lock:
+            self.cache.clear()
+
+
+def get_backend(name: str):
+    """
+    Create the backend by name, falling back to the database for secrets it does not hold
+
+    :param name: db, keyvault or env
+    :return: backend
+    """
+    if name == 'keyvault':
+        if not KEY_VAULT_URL:
+            raise ValueError('KEY_VAULT_URL is required for the keyvault secret backend')
+        return ChainBackend([KeyVaultBackend(KEY_VAULT_URL), DbBackend()])
+
+    if name == 'env':
+        return ChainBackend([EnvBackend(SECRETS_FILE), DbBackend()])
+
+    return DbBackend()
+
+
+provider = SecretProvider(get_backend(SECRET_BACKEND))  # Per-process secret provider
@@ -0,0 +1,282 @@
+"""
+Streaming parser for Analytics reports, and disk-backed rows and email bodies for reports larger than the memory
+budget.
+"""
+import json
+import logging
+import mmap
+import os
+import tempfile
+from array import array
+from collections.abc import Sequence
+from typing import IO, Any, Callable, Iterator, overload
+from lxml import etree  # type:ignore[import-untyped]
+from deadline import DELIVERY_RESERVE, Deadline
+
+# Rows held in memory take about five times the size of the XML they were parsed from (a 52 MB report with 200,000
+# rows of 8 columns peaks at 327 MB in memory and 87 MB when spilled), so the default keeps a report parsed in memory
+# below about 100 MB.
+MEMORY_BUDGET = int(float(os.getenv('MEMORY_BUDGET_MB', '16')) * 1024 * 1024)  # Largest response parsed in memory
+CHUNK_SIZE = 1024 * 1024  # Bytes read from the response at a time
+RELEASE_SIZE = 8 * 1024 * 1024  # Bytes of mapped rows read before their pages are released
+
+
+class RowFile(Sequence):
+    """
+    Rows stored as JSON lines in a temporary memory-mapped file
+
+    Only the offset of each row is kept in memory. Rows are decoded from the mapped file when they are read, so
+    iterating over a RowFile holds one row at a time.
+    """
+    def __init__(self) -> None:
+        """
+        Row file
+
+        :return: None
+        """
+        self.file = tempfile.TemporaryFile()  # pylint: disable=consider-using-with  # Removed when closed
+        self.offsets = array('Q', [0])  # Start offset of each row, plus the end of the last row
+        self.map: mmap.mmap | None = None
+
+    def append(self, row: dict[str, str]) -> None:
+        """
+        Add a row to the end of the file
+
+        :param row: dict
+        :return: None
+        """
+        data = json.dumps(row, separators=(',', ':')).encode('utf-8') + b'\n'  # Encode the row
+        self.file.write(data)  # Write the row
+        self.offsets.append(self.offsets[-1] + len(data))  # Record where the next row starts
+
+    def finish(self) -> 'RowFile':
+        """
+        Map the file for reading once every row has been written
+
+        :return: RowFile
+        """
+        self.file.flush()  # Write the buffered rows to disk
+
+        if len(self) and self.map is None:  # An empty file cannot be mapped
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self
+
+    def close(self) -> None:
+        """
+        Unmap and remove the file
+
+        :return: None
+        """
+        if self.map is not None:
+            self.map.close()
+
+        self.file.close()
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @overload
+    def __getitem__(self, index: int) -> dict[str, str]: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[dict[str, str]]: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):  # Decode each row in the slice
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:  # Count negative indexes from the end
+            index += len(self)
+
+        if not 0 <= index < len(self) or self.map is None:
+            raise IndexError('row index out of range')
+
+        return json.loads(self.map[self.offsets[index]:self.offsets[index + 1]])
+
+    def __iter__(self):
+        released = 0  # Offset up to which the mapped pages have been released
+
+        for index in range(len(self)):  # Decode the rows in order
+            yield self[index]
+
+            end = self.offsets[index + 1]  # Get the end of the row
+
+            if end - released >= RELEASE_SIZE and hasattr(mmap, 'MADV_DONTNEED'):  # Release the pages already read
+                start, released = released, end - end % mmap.PAGESIZE
+                self.map.madvise(mmap.MADV_DONTNEED, start, released - start)  # type:ignore[union-attr]
+
+
+class BodyFile:
+    """
+    Email body rendered to a temporary file, already escaped as the contents of a JSON string
+
+    The body of a report spilled to disk is as large as the report, so it is written to disk as it is rendered and
+    read back in chunks when the webhook payload is streamed. Chunks are read by offset, so the email can be sent to
+    several recipients at once. The file is removed when the email is released.
+    """
+    def __init__(self) -> None:
+        """
+        Body file
+
+        :return: None
+        """
+        self.file = tempfile.TemporaryFile()  # pylint: disable=consider-using-with  # Removed when released
+        self.size = 0  # Bytes written
+
+    def write(self, text: str) -> None:
+        """
+        Add text to the end of the body
+
+        :param text: str
+        :return: None
+        """
+        data = json.dumps(text)[1:-1].encode('ascii')  # Escape the text without its quotes
+        self.file.write(data)
+        self.size += len(data)
+
+    def finish(self) -> 'BodyFile':
+        """
+        Flush the file for reading once the whole body has been written
+
+        :return: BodyFile
+        """
+        self.file.flush()  # Write the buffered body to disk
+
+        return self
+
+    def chunks(self) -> Iterator[bytes]:
+        """
+        Read the escaped body back a chunk at a time
+
+        :return: iterator of bytes
+        """
+        for offset in range(0, self.size, CHUNK_SIZE):  # Read each chunk by its offset, without seeking
+            yield os.pread(self.file.fileno(), CHUNK_SIZE, offset)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __str__(self) -> str:
+        return json.loads(b'"' + b''.join(self.chunks()) + b'"')
+
+
+def spool_response(response: Any, deadline: Deadline | None = None) -> tuple[IO[bytes], int] | None:
+    """
+    Read the response body into a temporary file that stays in memory until it exceeds the memory budget
+
+    The request's timeout only limits the wait for each chunk, so a slow body could run past the deadline. The
+    deadline is checked after every chunk and the download is abandoned once the time left falls below the delivery
+    reserve.
+
+    :param response: requests.Response
+    :param deadline: Deadline of the invocation
+    :return: (file object positioned at the start of the body, size of the body), or None if the deadline was reached
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=MEMORY_BUDGET)  # pylint: disable=consider-using-with
+    size = 0  # Count the bytes read
+
+    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):  # Stream the body
+        body.write(chunk)
+        size += len(chunk)
+
+        if deadline and deadline.remaining() < DELIVERY_RESERVE:  # Check for the time kept back for delivery
+            logging.warning('Download abandoned after %s bytes: %s', size, deadline)
+            response.close()  # Drop the rest of the body
+            body.close()
+            return None
+
+    body.seek(0)  # Rewind for reading
+
+    return body, size  # type:ignore[return-value]
+
+
+def parse_file(
+        body: IO[bytes],
+        rows: RowFile | list[dict[str, str]],
+        project: Callable[[dict[str, str]], dict[str, str]] | None = None,
+        columns: dict[str, str] | None = None
+) -> dict[str, str] | None:
+    """
+    Stream-parse one page of an Analytics response, adding its rows to a row file or list
+
+    Each element is discarded as soon as it has been read, so memory does not grow with the number of rows. The
+    schema comes before the rows, so the columns are projected once, at the first row. lxml still parses every value
+    of a row, but the values of the columns left out are dropped with the row and never stored. Only the first page
+    of a report has the schema; later pages are parsed with the columns it gave.
+
+    :param body: file object of the page
+    :param rows: RowFile or list to add the rows to
+    :param project: turns the raw columns into the columns to keep, defaults to keeping every column
+    :param columns: projected columns from an earlier page
+    :return: dict of column name to heading or None
+    """
+    schema: dict[str, str] = {}  # Create a dictionary of columns
+    kept = columns  # Projected columns, once the schema has been read
+
+    try:
+        for _, element in etree.iterparse(body, events=('end',), huge_tree=True):  # Iterate through the elements
+            tag = etree.QName(element).localname  # Get the tag without its namespace
+
+            if tag == 'error':  # Check for Alma errors
+                logging.error('Error: %s', element.text)
+                return None
+
+            if tag == 'element' and kept is None:  # Add the column to the dictionary
+                headings = [
+                    value for key, value in element.attrib.items() if etree.QName(key).localname == 'columnHeading'
+                ]
+                schema[element.get('name')] = headings[0] if headings else ''
+
+            elif tag == 'Row':  # Add the row
+                if kept is None:  # Project the columns
+                    kept = project(schema) if project else schema
+
+                values = ((etree.QName(kid).localname, kid) for kid in element)  # Get the row's values by column
+                rows.append({name: kid.text or '' for name, kid in values if name in kept})
+
+                element.clear()  # Discard the row and the rows before it
+
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+    except etree.XMLSyntaxError as e:  # Handle unparseable responses
+        logging.error('Error: %s', e)
+        return None
+
+    if kept is None:  # Project the columns of a report without rows
+        kept = project(schema) if project else schema
+
+    logging.debug('Rows parsed: %s', len(rows))  # Log the success message
+
+    return kept
+
+
+def get_page_status(body: IO[bytes]) -> tuple[str | None, bool] | None:
+    """
+    Read the resumption token and whether the report is finished from a page of an Analytics response
+
+    Alma puts both before the rows, so the page is only read up to IsFinished. The page is rewound for parsing.
+
+    :param body: file object of the page
+    :return: (ResumptionToken or None, IsFinished) or None if the page has no IsFinished
+    """
+    token = None  # Only the first page has a token
+
+    try:
+        for _, element in etree.iterparse(  # Iterate through the status elements
+                body, events=('end',), tag=('{*}ResumptionToken', '{*}IsFinished'), huge_tree=True
+        ):
+            if etree.QName(element).localname == 'ResumptionToken':  # Keep the token for the next pages
+                token = element.text
+                continue
+
+            body.seek(0)  # Rewind for parsing
+
+            return token, (element.text or '').strip().lower() == 'true'
+    except etree.XMLSyntaxError as e:  # Handle exceptions
+        logging.error('Error: %s', e)
+
+    body.seek(0)  # Rewind for parsing
+    logging.error('No IsFinished in the Analytics response')
+
+    return None
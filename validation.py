@@ -0,0 +1,207 @@
+"""
+Local validation of item barcode and row/tray rules.
+
+The item_checks trigger needs an Azuretrigger row with the code item_checks, and one Analysis per IZ whose path is an
+item extract with the barcode and row/tray columns, with the IZ's recipients. Once that row exists, the triggers its
+rules replace (the Rule codes, e.g. iz_no_row_tray) are no longer scheduled.
+
+A rule is only applied once its settings are made: ROW_TRAY_HEADING for the row/tray rules, ROW_TRAY_PATTERN for the
+incorrect row/tray rule, and SCF_IZ_CODE for the X suffix rule, which only applies to the SCF's items. The SCF's
+row/trays are left to the scf_no_row_tray and scf_incorrect_row_tray triggers, which stay scheduled, so the IZ
+row/tray rules skip the SCF.
+"""
+import logging
+import os
+import re
+from typing import Callable
+from controllers import BARCODE_HEADING
+from models import Analysis, Report
+
+ROW_TRAY_HEADING = os.getenv('ROW_TRAY_HEADING')  # Column heading of the row/tray, e.g. Internal Note 1
+ROW_TRAY_PATTERN = os.getenv('ROW_TRAY_PATTERN')  # Regular expression a valid row/tray fully matches
+ROW_TRAY_REGEX = re.compile(ROW_TRAY_PATTERN) if ROW_TRAY_PATTERN else None  # Compiled once for every column
+SCF_IZ_CODE = os.getenv('SCF_IZ_CODE')  # IZ code of the SCF, whose barcodes must end in X
+
+
+class Rule:  # pylint: disable=too-few-public-methods
+    """
+    Rule object
+    """
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+            self,
+            code: str,
+            name: str,
+            heading: str,
+            check: Callable[[list[str]], list[bool]],
+            izs: list[str] | None = None,
+            exclude: list[str] | None = None
+    ) -> None:
+        """
+        Rule object
+
+        :param code: trigger code the rule replaces
+        :param name: name of the rule's report
+        :param heading: column heading the rule checks
+        :param check: function returning whether each value in a column breaks the rule
+        :param izs: codes of the IZs the rule applies to, defaults to every IZ
+        :param exclude: codes of the IZs the rule does not apply to
+        :return: None
+        """
+        self.code = code
+        self.name = name
+        self.heading = heading
+        self.check = check
+        self.izs = izs
+        self.exclude = exclude or []
+
+    def applies(self, iz: str | None) -> bool:
+        """
+        Check whether the rule applies to an IZ
+
+        :param iz: IZ code, or None for any IZ
+        :return: bool
+        """
+        if iz is None:  # Apply every rule when the IZ is not known
+            return True
+
+        return (self.izs is None or iz in self.izs) and iz not in self.exclude
+
+    def __str__(self) -> str:
+        """
+        Return the rule as a string
+
+        :return: str
+        """
+        return f"{self.code} ({self.heading})"
+
+
+def missing(values: list[str]) -> list[bool]:
+    """
+    Flag empty values
+
+    :param values: column values
+    :return: list of bool
+    """
+    return [not value.strip() for value in values]
+
+
+def malformed(values: list[str]) -> list[bool]:
+    """
+    Flag values that are present but do not match ROW_TRAY_PATTERN
+
+    Blank values are left to the missing rule.
+
+    :param values: column values
+    :return: list of bool
+    """
+    match = ROW_TRAY_REGEX.fullmatch  # type:ignore[union-attr]  # Bind the compiled pattern once for the whole column
+    return [bool(value.strip()) and match(value.strip()) is None for value in values]
+
+
+def no_x(values: list[str]) -> list[bool]:
+    """
+    Flag barcodes that are present but do not end in X
+
+    :param values: column values
+    :return: list of bool
+    """
+    return [bool(value.strip()) and not value.rstrip().upper().endswith('X') for value in values]
+
+
+RULES: list[Rule] = []  # Rules applied to the item extract, leaving out those whose settings are not made
+
+SCF = [SCF_IZ_CODE] if SCF_IZ_CODE else None  # The SCF has its own row/tray triggers
+
+if ROW_TRAY_HEADING:
+    RULES.append(Rule('iz_no_row_tray', 'No Row/Tray', ROW_TRAY_HEADING, missing, exclude=SCF))
+
+if ROW_TRAY_HEADING and ROW_TRAY_REGEX:
+    RULES.append(Rule('iz_incorrect_row_tray', 'Incorrect Row/Tray', ROW_TRAY_HEADING, malformed, exclude=SCF))
+
+if SCF_IZ_CODE:
+    RULES.append(Rule('scf_no_x', 'No X', BARCODE_HEADING, no_x, izs=[SCF_IZ_CODE]))
+
+
+def get_column(report: Report, heading: str) -> list[str] | None:
+    """
+    Get the values of a column from the report by heading
+
+    :param report: Report
+    :param heading: column heading
+    :return: list of values or None
+    """
+    columns = report.data['data']['columns']  # Get the columns from the report
+    keys = [key for key, value in columns.items() if value == heading]  # Find the column
+
+    if not keys:  # Check for a missing column
+        logging.error('No %s column in report %s', heading, report.data['data']['report_name'])
+        return None
+
+    return [row.get(keys[0], '') for row in report.data['data']['rows']]  # Get the column values
+
+
+def validate(report: Report, rules: list[Rule] | None = None, iz: str | None = None) -> dict[str, list[int]]:
+    """
+    Apply the rules to the report in one pass per column
+
+    :param report: Report
+    :param rules: list of Rule, defaults to RULES
+    :param iz: IZ code of the report, to skip rules that do not apply to it
+    :return: dict of rule code to the indexes of the rows breaking the rule
+    """
+    columns: dict[str, list[str] | None] = {}  # Extract each column once for every rule that checks it
+    results = {}  # Create the dictionary of results
+
+    for rule in rules or RULES:  # Iterate through the rules
+        if not rule.applies(iz):  # Skip rules scoped to other IZs
+            continue
+
+        if rule.heading not in columns:
+            columns[rule.heading] = get_column(report, rule.heading)
+
+        values = columns[rule.heading]  # Get the column values
+
+        if values is None:  # Skip rules whose column is missing
+            continue
+
+        results[rule.code] = [i for i, failed in enumerate(rule.check(values)) if failed]  # Apply the rule
+
+        logging.debug('Rule %s: %s rows', rule, len(results[rule.code]))  # Log the rule result
+
+    return results
+
+
+def get_rule_reports(report: Report, analysis: Analysis, rules: list[Rule] | None = None) -> list[Report]:
+    """
+    Split the report into one report per rule with the rows breaking it
+
+    :param report: Report
+    :param analysis: Analysis
+    :param rules: list of Rule, defaults to RULES
+    :return: list of Report
+    """
+    if not rules and not RULES:  # Check for rules whose settings are not made
+        logging.warning('No item checks configured: set ROW_TRAY_HEADING, ROW_TRAY_PATTERN or SCF_IZ_CODE')
+        return []
+
+    rows = report.data['data']['rows']  # Get the rows from the report
+    results = validate(report, rules, analysis.iz.code)  # Apply the rules
+    reports = []  # Create a list of reports
+
+    for rule in rules or RULES:  # Iterate through the rules
+        if not results.get(rule.code):  # Skip rules with no results
+            continue
+
+        reports.append(Report(  # Create the report object
+            data={
+                'status': 'success',
+                'message': 'Rule applied',
+                'data': {
+                    'report_name': analysis.iz.code.upper() + ' ' + rule.name,
+                    'columns': report.data['data']['columns'],
+                    'rows': [rows[i] for i in results[rule.code]]
+                }
+            }
+        ))
+
+    return reports